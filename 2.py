@@ -1,101 +1,607 @@
 import time
-import requests
-import bs4
 import re
 import os
 import random
 import json
-import urllib3
+import codecs
+import sqlite3
+import zlib
+import zipfile
+import html
 import threading
 import atexit
 import signal
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from tqdm import tqdm
-from fake_useragent import UserAgent
+import argparse
+import queue
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 from typing import Dict
-from ebooklib import epub
-import subprocess
+from html.parser import HTMLParser
 import socket
+import tempfile
+from contextlib import contextmanager
 
-# 禁用SSL证书验证警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-requests.packages.urllib3.disable_warnings()
+# requests、tqdm、asyncio、subprocess 等较重的模块在首次使用时才导入，
+# 只查看帮助、停止常驻服务或作为清洗子进程被导入时不必加载
 
 # 全局配置
 CONFIG = {
     "max_workers": 4,
     "request_timeout": 15,
-    "status_file": "chapter.json",
+    "site_base": "https://fanqienovel.com",  # 番茄小说网站地址（目录、书籍信息），基准测试时指向本地模拟服务
+    "engine": "thread",  # 下载引擎：thread 或 async
+    "status_file": "chapter_{book_id}_{format}.journal",  # 每本书每种格式一个断点续传日志
+    "legacy_status_file": "chapter.json",  # 旧版本的进度文件，首次下载TXT时导入
+    "book_state_file": "book_{book_id}.json",  # 上次同步的目录与书籍信息，更新模式据此只下载新章节
+    "journal": {
+        "fsync_every": 200,  # 累计多少条记录强制刷盘一次
+        "compact_ratio": 2  # 日志行数超过已完成章节数的该倍数时压缩
+    },
     "official_api": {
         "enabled": False,
-        "batch_endpoint": "http://127.0.0.1:8080/content",
+        "host": "127.0.0.1",  # api.py的监听地址
+        "connect_host": None,  # 客户端连接服务使用的地址，None表示与host相同
+        "port": 8080,
+        "batch_endpoint": "http://127.0.0.1:8080/content",  # 启动服务时根据host/port生成
+        "startup_timeout": 20,  # 等待api.py就绪的最长秒数
+        "daemon": False,  # 常驻模式：程序退出后保留api.py，下次运行直接复用
+        "instances": 1,  # 启动的api.py实例数，依次使用port开始的连续端口
+        "log_file": None,  # api.py的输出另存到该文件（可包含{port}），超过log_max_bytes时轮转
+        "log_max_bytes": 5 * 1024 * 1024,
+        "log_lines": 200,  # 内存中为每个实例保留的最近输出行数，批量请求失败时显示
+        "stream": True,  # 边接收边解析批量响应，先到的章节先交给流水线，不在内存中保留完整响应
+        "stream_chunk_size": 64 * 1024,
         "max_batch_size": 30,
-            "timeout": 30,
-            "batch_wait": 1.2
+            "timeout": 30
+    },
+    "epub": {
+        "volume_chapters": 0,  # 每卷最多章节数，0表示不按章节数分卷
+        "volume_bytes": 100 * 1024 * 1024  # 每卷章节内容的最大字节数，0表示不按大小分卷
+    },
+    "scheduler": {
+        "max_books": 2,  # 同时下载的书籍数
+        "max_inflight": 8  # 所有书籍合计的在途批量请求上限
+    },
+    "cache": {
+        "enabled": True,  # 章节正文缓存，跨多次运行和不同格式共用
+        "path": os.path.join(os.path.expanduser("~"), ".tomato_novel", "chapter_cache.db"),
+        "max_bytes": 512 * 1024 * 1024  # 超出后按最近最少使用淘汰
+    },
+    "metadata_cache": {
+        "enabled": True,  # 缓存解析后的目录和书籍信息，重复运行或选择章节范围时不必重新下载解析
+        "path": os.path.join(os.path.expanduser("~"), ".tomato_novel", "metadata_cache.db"),
+        "directory_ttl": 300,  # 目录缓存在该秒数内直接使用，过期后带ETag/Last-Modified向服务器确认；更新模式总是确认
+        "info_ttl": 24 * 3600  # 书名、作者、简介的缓存时间
+    },
+    "metrics": {
+        "summary_file": None,  # 下载结束后把各阶段耗时与错误计数写入该JSON文件，可包含{book_id}
+        "prometheus_port": None  # 下载期间在该端口提供Prometheus格式的指标（/metrics）
+    },
+    "pipeline": {
+        "processes": 0,  # 清洗/渲染使用的进程数，0表示在线程中处理
+        "queue_size": 256,  # 各阶段之间队列的容量
+        "reorder_memory": 32 * 1024 * 1024  # TXT重排缓冲区在内存中保存的压缩后字节数上限，超出部分写入临时文件
+    },
+    "adaptive": {
+        "enabled": True,  # 根据接口延迟与成功率自动调整批量大小和并发数
+        "min_batch_size": 5,
+        "max_batch_size": 60,
+        "min_workers": 1,
+        "max_workers": 8,
+        "latency_target": 8,  # 单次批量请求超过该秒数视为变慢
+        "base_delay": 1,
+        "max_delay": 30,
+        "log_file": None  # 记录每次参数调整，便于根据实际运行调优默认值
+    },
+    "hedge": {
+        "enabled": False,  # 对冲请求：批量请求迟迟不返回时再发一个相同的请求，取先返回的结果
+        "percentile": 0.95,  # 等待时间取近期批量请求耗时的该分位数
+        "min_delay": 0.5,  # 最短等待秒数
+        "min_samples": 20,  # 积累足够的耗时样本后才开始对冲
+        "max_ratio": 0.1  # 对冲请求数最多占批量请求数的比例，限制额外负载
+    },
+    "rate_limit": {
+        "requests_per_second": 0,  # 令牌桶限速：每秒请求数，0表示不限
+        "chapters_per_second": 0,  # 每秒请求的章节数（批量接口），0表示不限
+        "burst": 1,  # 空闲后允许突发的量，按秒计（即最多连续发出 速率×burst 的请求）
+        "shared": True,  # 同一台机器上的多个下载进程共用限额
+        "state_file": os.path.join(os.path.expanduser("~"), ".tomato_novel", "rate_limit.state")
+    },
+    "retry": {
+        "max_attempts": 12,  # 单个章节最多请求的次数，用完后放弃并在结束时列出，0表示不限
+        "base_delay": 1,  # 章节重试的初始等待秒数，之后每次翻倍
+        "max_delay": 60
+    },
+    "user_agent": {
+        "fixed": None,  # 指定固定的User-Agent
+        "offline": False,  # 不加载fake_useragent，使用内置UA
+        "pool_size": 20
+    },
+    "http": {
+        "pool_size": None,  # 批量接口每个主机的连接池大小，None表示跟随max_workers
+        "retries": 2,  # 外部主机的重试次数；批量接口只重试连接失败，超时和错误状态交给重试调度器
+        "backoff_factor": 0.5
     }
 }
 
 # 全局变量
-official_api_process = None  # 存储API进程
+official_api_processes = []  # 存储API进程
+api_logs = {}  # 端口 -> api.py最近的输出行
+api_log_reported = {}  # 端口 -> 上次显示输出的时间
+api_log_lock = threading.Lock()
+api_backends = None  # 批量接口实例的负载均衡
 print_lock = threading.Lock()  # 线程锁
 printed_errors = set()  # 打印的错误信息
+metrics_server = None  # Prometheus指标服务
+http_session = None  # 进程内共享的HTTP会话
+session_lock = threading.RLock()  # 可重入：创建会话时会获取负载均衡实例
+adaptive_controller = None  # 批量大小/并发数控制器
+process_pool = None  # 清洗/渲染共用的进程池
+chapter_cache = None  # 本地章节缓存
+metadata_cache = None  # 目录与书籍信息缓存
+worker_pool = None  # 所有书籍共用的批量请求线程池
+hedge_pool = None  # 对冲请求使用的线程池
+hedge_policy = None
+batch_slots = None  # 全局在途批量请求数限制
+rate_limiter = None  # 请求与章节的令牌桶限速
+api_start_lock = threading.Lock()
+json_loads = None  # 安装了orjson时使用orjson.loads
+user_agent_pool = None  # 预生成的UA轮换池
+user_agent_lock = threading.Lock()
 
-def print_once(msg: str):
-    """报错优化"""
+# 内置UA，离线模式或fake_useragent数据不可用时使用
+FALLBACK_USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36 Edg/123.0.0.0"
+]
+
+class Metrics:
+    """运行指标：各阶段的调用次数、耗时直方图与按类型的错误计数"""
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.errors = {}
+        self.events = {}
+        self.scopes = []  # 正在进行的子统计（每次Run一个），同时接收之后的所有记录
+
+    def start_scope(self):
+        """开始一个子统计，只包含此后的记录；多本书同时下载时共用的网络阶段会同时计入各本书"""
+        scope = Metrics()
+        with self.lock:
+            # 整体替换列表，记录时不加锁遍历
+            self.scopes = self.scopes + [scope]
+        return scope
+
+    def end_scope(self, scope):
+        with self.lock:
+            self.scopes = [item for item in self.scopes if item is not scope]
+
+    def observe(self, stage, seconds, ok=True):
+        for scope in self.scopes:
+            scope.observe(stage, seconds, ok)
+        with self.lock:
+            data = self.stages.get(stage)
+            if data is None:
+                data = self.stages[stage] = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                                             "buckets": [0] * (len(self.BUCKETS) + 1)}
+            data["count"] += 1
+            data["total"] += seconds
+            data["max"] = max(data["max"], seconds)
+            if not ok:
+                data["errors"] += 1
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            data["buckets"][i] += 1
+
+    @contextmanager
+    def timed(self, stage):
+        """统计代码块的耗时，抛出异常时计为失败"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.perf_counter() - started, ok=False)
+            raise
+        self.observe(stage, time.perf_counter() - started)
+
+    def count_error(self, kind):
+        for scope in self.scopes:
+            scope.count_error(kind)
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def count(self, event):
+        """非错误的事件计数，例如对冲请求"""
+        for scope in self.scopes:
+            scope.count(event)
+        with self.lock:
+            self.events[event] = self.events.get(event, 0) + 1
+
+    def quantile(self, data, ratio):
+        """按直方图估算分位数（取所在区间的上界）"""
+        target = data["count"] * ratio
+        seen = 0
+        for bound, count in zip(self.BUCKETS, data["buckets"]):
+            seen += count
+            if seen >= target:
+                return min(bound, data["max"])
+        return data["max"]
+
+    def summary(self):
+        """JSON格式的汇总"""
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": data["count"],
+                    "errors": data["errors"],
+                    "total_seconds": round(data["total"], 4),
+                    "avg_ms": round(data["total"] / data["count"] * 1000, 3),
+                    "p50_ms": round(self.quantile(data, 0.5) * 1000, 3),
+                    "p95_ms": round(self.quantile(data, 0.95) * 1000, 3),
+                    "max_ms": round(data["max"] * 1000, 3),
+                }
+                for stage, data in self.stages.items()
+            }
+            return {"stages": stages, "errors": dict(self.errors), "events": dict(self.events)}
+
+    def prometheus(self):
+        """Prometheus文本格式"""
+        lines = ["# TYPE tomato_stage_seconds histogram", "# TYPE tomato_stage_errors_total counter",
+                 "# TYPE tomato_errors_total counter", "# TYPE tomato_events_total counter"]
+        with self.lock:
+            for stage, data in self.stages.items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), data["buckets"]):
+                    cumulative += count
+                    lines.append(f'tomato_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'tomato_stage_seconds_sum{{stage="{stage}"}} {data["total"]}')
+                lines.append(f'tomato_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
+                lines.append(f'tomato_stage_errors_total{{stage="{stage}"}} {data["errors"]}')
+            for kind, count in self.errors.items():
+                lines.append(f'tomato_errors_total{{kind="{kind}"}} {count}')
+            for event, count in self.events.items():
+                lines.append(f'tomato_events_total{{event="{event}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def print_once(msg: str, kind="other"):
+    """报错优化：按类型计数（kind为None时不计数），相同的信息只打印一次"""
+    if kind:
+        metrics.count_error(kind)
     with print_lock:
         if msg in printed_errors:
             return
         printed_errors.add(msg)
         print(msg)
 
+def start_metrics_server():
+    """配置了端口时启动Prometheus指标服务（只启动一次）"""
+    global metrics_server
+    port = CONFIG["metrics"]["prometheus_port"]
+    if not port:
+        return
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with session_lock:
+        if metrics_server is not None:
+            return
+        try:
+            metrics_server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        except OSError as e:
+            print_once(f"指标服务启动失败: {e}", "metrics")
+            return
+        metrics_server.daemon_threads = True
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+        print(f"指标服务: http://127.0.0.1:{port}/metrics")
+
+def save_metrics_summary(book_id, book_metrics):
+    """打印本书下载期间（book_metrics）各阶段耗时，配置了文件时写入JSON汇总"""
+    summary = book_metrics.summary()
+    stages = summary["stages"]
+    labels = (("http_request", "HTTP请求"), ("batch_request", "批量请求"), ("rate_limit", "限速等待"),
+              ("clean", "清洗"), ("write", "写入"), ("save_status", "保存进度"))
+    parts = [f"{label} {stages[stage]['count']} 次/{stages[stage]['total_seconds']:.2f} 秒"
+             for stage, label in labels if stage in stages]
+    if parts:
+        print("阶段耗时: " + "，".join(parts))
+    if summary["errors"]:
+        print("错误计数: " + "，".join(f"{kind} {count}" for kind, count in summary["errors"].items()))
+    if summary["events"]:
+        print("事件计数: " + "，".join(f"{event} {count}" for event, count in summary["events"].items()))
+    path = CONFIG["metrics"]["summary_file"]
+    if path:
+        summary["book_id"] = book_id
+        with open(path.format(book_id=book_id), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+def get_api_pid_file(port):
+    """常驻模式下记录api.py进程号的文件"""
+    return os.path.join(tempfile.gettempdir(), f"tomato_novel_api_{port}.pid")
+
+def wait_for_api(host, port, deadline, process=None):
+    """轮询直到API服务可以响应HTTP请求，超过截止时间或进程退出时返回False"""
+    import requests
+    delay = 0.1
+    while True:
+        if check_port_open(port, host):
+            try:
+                # 任意HTTP响应都说明服务已能处理请求
+                requests.get(f"http://{host}:{port}/content", params={'item_ids': ''}, timeout=2)
+                return True
+            except requests.RequestException:
+                pass
+        if process is not None and process.poll() is not None:
+            return False
+        if time.time() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+
+class ApiLogFile:
+    """api.py输出的日志文件，超过大小上限时轮转为 .1 备份"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = open(path, 'ab')
+
+    def write(self, line):
+        self.file.write(line)
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.file.close()
+            os.replace(self.path, self.path + ".1")
+            self.file = open(self.path, 'ab')
+
+    def close(self):
+        self.file.close()
+
+def pump_api_log(process, port):
+    """持续读取api.py的输出，避免管道写满后服务阻塞；保留最近的若干行，按配置另存到日志文件"""
+    api_config = CONFIG["official_api"]
+    lines = deque(maxlen=api_config["log_lines"])
+    with api_log_lock:
+        api_logs[port] = lines
+    log_file = None
+    if api_config["log_file"]:
+        try:
+            log_file = ApiLogFile(api_config["log_file"].format(port=port), api_config["log_max_bytes"])
+        except OSError as e:
+            print_once(f"无法打开官方API服务日志文件: {e}", "api_log")
+    try:
+        for line in iter(process.stdout.readline, b''):
+            with api_log_lock:
+                lines.append(line.decode('utf-8', errors='replace').rstrip())
+            if log_file is not None:
+                log_file.write(line)
+    except (OSError, ValueError):
+        pass
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+def report_api_log(endpoint, count=10):
+    """批量请求失败时显示对应实例最近的输出，同一实例30秒内只显示一次"""
+    try:
+        port = int(endpoint.split("/")[2].rsplit(":", 1)[1])
+    except (IndexError, ValueError):
+        return
+    with api_log_lock:
+        lines = api_logs.get(port)
+        now = time.time()
+        if not lines or now - api_log_reported.get(port, 0) < 30:
+            return
+        api_log_reported[port] = now
+        recent = list(lines)[-count:]
+    with print_lock:
+        print(f"官方API服务（端口 {port}）最近的输出：")
+        for line in recent:
+            print(f"  | {line}")
+
+def spawn_api_process(host, port):
+    """启动一个api.py实例"""
+    import subprocess
+    # 通过环境变量传递监听地址
+    env = dict(os.environ, TOMATO_API_HOST=host, TOMATO_API_PORT=str(port))
+    if CONFIG["official_api"]["daemon"]:
+        # 常驻模式：脱离当前进程，退出时不终止；输出无人读取，只能直接写入日志文件
+        log_path = CONFIG["official_api"]["log_file"]
+        output = open(log_path.format(port=port), 'ab') if log_path else subprocess.DEVNULL
+        options = {"stdout": output, "stderr": subprocess.STDOUT}
+        if os.name == 'nt':
+            options["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            options["start_new_session"] = True
+        process = subprocess.Popen([sys.executable, "api.py"], env=env, **options)
+        if log_path:
+            output.close()
+        with open(get_api_pid_file(port), 'w') as f:
+            f.write(str(process.pid))
+        return process
+    process = subprocess.Popen([sys.executable, "api.py"], env=env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    threading.Thread(target=pump_api_log, args=(process, port), daemon=True).start()
+    official_api_processes.append(process)
+    return process
+
+def get_api_connect_host():
+    """客户端连接官方API服务使用的地址"""
+    api_config = CONFIG["official_api"]
+    return api_config["connect_host"] or api_config["host"]
+
 def start_official_api():
-    """启动官方API服务"""
-    global official_api_process
+    """启动官方API服务（可多实例），已在运行（包括常驻的服务）的实例直接复用"""
+    api_config = CONFIG["official_api"]
+    host = get_api_connect_host()
+    ports = [api_config["port"] + i for i in range(max(1, api_config["instances"]))]
+    api_config["batch_endpoint"] = f"http://{host}:{ports[0]}/content"
 
-    if check_port_open(8080):
+    running = [port for port in ports if wait_for_api(host, port, time.time())]
+    to_start = [port for port in ports if port not in running]
+    if not to_start:
         print("官方API服务已在运行")
-        return True
-    
-    if not os.path.exists("api.py"):
+    elif not os.path.exists("api.py"):
         print("错误: 未找到api.py文件")
+    else:
+        # 启动API服务
+        try:
+            # 使用subprocess启动api.py
+            spawned = {port: spawn_api_process(api_config["host"], port) for port in to_start}
+
+            # 轮询等待API服务就绪
+            deadline = time.time() + api_config["startup_timeout"]
+            for port, process in spawned.items():
+                if wait_for_api(host, port, deadline, process):
+                    running.append(port)
+                elif len(ports) > 1:
+                    print_once(f"官方API服务实例（端口 {port}）启动失败", "api_start")
+        except Exception as e:
+            print_once(f"启动官方API服务时出错: {e}", "api_start")
+        if running:
+            print("官方API服务启动成功" + (f"，共 {len(running)} 个实例" if len(running) > 1 else ""))
+
+    if not running:
+        print_once("官方API服务启动失败", "api_start")
+        return False
+    set_api_backends([f"http://{host}:{port}/content" for port in sorted(running)])
+    return True
+
+def is_daemon_api(pid, port):
+    """确认pid文件记录的进程仍是该端口上的api.py：端口无人监听，或（能读取命令行时）进程不是api.py时返回False"""
+    if not check_port_open(port, get_api_connect_host()):
         return False
-    
-    # 启动API服务
     try:
-        # 使用subprocess启动api.py
-        official_api_process = subprocess.Popen([sys.executable, "api.py"],
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.PIPE)
+        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+            cmdline = f.read().split(b'\0')
+    except OSError:
+        # 没有/proc的系统只能依据端口判断；进程不存在时os.kill会报错
+        return not os.path.exists("/proc/self/cmdline")
+    return any(os.path.basename(arg) == b"api.py" for arg in cmdline)
 
-        # 等待API服务启动
-        time.sleep(5)
+def stop_daemon_api(port=None):
+    """停止常驻的API服务（所有实例）"""
+    api_config = CONFIG["official_api"]
+    port = port or api_config["port"]
+    stopped = False
+    for instance_port in range(port, port + max(1, api_config["instances"])):
+        pid_file = get_api_pid_file(instance_port)
+        try:
+            with open(pid_file, 'r') as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if not is_daemon_api(pid, instance_port):
+            # 重启等情况留下的过期pid文件，对应的进程可能已经是别的程序
+            print(f"端口 {instance_port} 的pid文件已过期，已删除")
+            os.remove(pid_file)
+            continue
+        try:
+            os.kill(pid, signal.SIGTERM)
+            print(f"常驻的官方API服务（端口 {instance_port}）已终止")
+        except OSError as e:
+            print(f"终止常驻的官方API服务失败: {e}")
+        os.remove(pid_file)
+        stopped = True
+    if not stopped:
+        print("没有找到常驻的官方API服务")
+    return stopped
 
-        # 检查端口是否开放
-        if check_port_open(8080):
-            print("官方API服务启动成功")
-            return True
-        else:
-            print_once("官方API服务启动失败")
-            return False
-    except Exception as e:
-        print_once(f"启动官方API服务时出错: {e}")
-        return False
+class BackendPool:
+    """批量接口多实例的负载均衡：选择在途请求最少的实例，超时或连接失败的实例暂时摘除"""
+
+    def __init__(self, endpoints):
+        self.backends = [{"endpoint": endpoint, "outstanding": 0, "failures": 0, "ejected_until": 0}
+                         for endpoint in endpoints]
+        self.lock = threading.Lock()
+        self.turn = 0
+
+    def acquire(self):
+        """选出一个实例并计入在途请求，负载相同时轮流选择"""
+        with self.lock:
+            now = time.time()
+            self.turn = (self.turn + 1) % len(self.backends)
+            ordered = self.backends[self.turn:] + self.backends[:self.turn]
+            candidates = [backend for backend in ordered if backend["ejected_until"] <= now]
+            if not candidates:
+                # 全部被摘除时选最早恢复的实例
+                candidates = [min(self.backends, key=lambda backend: backend["ejected_until"])]
+            backend = min(candidates, key=lambda backend: backend["outstanding"])
+            backend["outstanding"] += 1
+            return backend
+
+    def release(self, backend, healthy=True):
+        """请求结束，不健康时按连续失败次数摘除一段时间"""
+        with self.lock:
+            backend["outstanding"] -= 1
+            if healthy:
+                backend["failures"] = 0
+                return
+            backend["failures"] += 1
+            if len(self.backends) > 1:
+                backend["ejected_until"] = time.time() + min(60, 2 ** backend["failures"])
+
+    def endpoints(self):
+        return [backend["endpoint"] for backend in self.backends]
+
+def set_api_backends(endpoints):
+    """设置批量接口实例"""
+    global api_backends
+    api_backends = BackendPool(endpoints)
+    reset_session()
+
+def get_api_backends():
+    """获取批量接口实例的负载均衡，未启动多实例时只包含batch_endpoint"""
+    global api_backends
+    if api_backends is None:
+        with session_lock:
+            if api_backends is None:
+                api_backends = BackendPool([CONFIG["official_api"]["batch_endpoint"]])
+    return api_backends
 
 def stop_web_service():
-    """停止Web服务"""
-    global official_api_process
-    if official_api_process and official_api_process.poll() is None:
+    """停止Web服务（常驻模式启动的服务不会被停止）"""
+    while official_api_processes:
+        process = official_api_processes.pop()
+        if process.poll() is not None:
+            continue
+        import subprocess
         print("正在终止官方API服务...")
-        official_api_process.terminate()
+        process.terminate()
         try:
-            official_api_process.wait(timeout=5)
+            process.wait(timeout=5)
             print("官方API服务已终止")
         except subprocess.TimeoutExpired:
-            official_api_process.kill()
-            official_api_process.wait()
+            process.kill()
+            process.wait()
             print("强制终止了官方API服务")
-        official_api_process = None
         
 # 退出时自动关闭
 atexit.register(stop_web_service)
@@ -108,261 +614,2141 @@ def check_port_open(port, host='127.0.0.1'):
     sock.close()
     return result == 0
 
-def make_request(url, headers=None, params=None, data=None, method='GET', verify=False, timeout=None):
-    """通用的请求函数"""
+def create_session():
+    """创建带连接池和重试的HTTP会话"""
+    import requests
+    import urllib3
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # 禁用SSL证书验证警告
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    http_config = CONFIG["http"]
+    retry = Retry(
+        total=http_config["retries"],
+        backoff_factor=http_config["backoff_factor"],
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False
+    )
+    # 批量接口超时或返回错误时立即交给调用方，由自适应控制器、实例摘除、对冲和重试调度器处理
+    batch_retry = Retry(
+        total=http_config["retries"],
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=http_config["backoff_factor"],
+        raise_on_status=False
+    )
+    pool_size = http_config["pool_size"] or CONFIG["max_workers"]
+    if CONFIG["adaptive"]["enabled"]:
+        # 并发数可能被自适应控制器调大
+        pool_size = max(pool_size, CONFIG["adaptive"]["max_workers"])
+    # 多本书同时下载时共用同一个连接池
+    pool_size = max(pool_size, CONFIG["scheduler"]["max_inflight"])
+
+    session = requests.Session()
+    # 默认适配器：番茄官网等外部主机，请求量小
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    # 本地批量接口：每个实例的连接池与并发线程数一致，保持长连接
+    for endpoint in get_api_backends().endpoints():
+        origin = "/".join(endpoint.split("/")[:3])
+        session.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=batch_retry))
+    return session
+
+def get_session():
+    """获取共享的HTTP会话（线程安全）"""
+    global http_session
+    if http_session is None:
+        with session_lock:
+            if http_session is None:
+                http_session = create_session()
+    return http_session
+
+def reset_session():
+    """配置变化后重建HTTP会话"""
+    global http_session
+    with session_lock:
+        if http_session is not None:
+            http_session.close()
+        http_session = None
+
+def get_connection_stats():
+    """统计连接复用次数与新建连接次数"""
+    stats = {"requests": 0, "new_connections": 0, "reused": 0}
+    session = http_session
+    if session is None:
+        return stats
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["requests"] += pool.num_requests
+            stats["new_connections"] += pool.num_connections
+    stats["reused"] = max(0, stats["requests"] - stats["new_connections"])
+    return stats
+
+@contextmanager
+def locked_file(f):
+    """对已打开的文件加进程间互斥锁"""
+    try:
+        import fcntl
+    except ImportError:
+        # Windows
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class RateLimiter:
+    """令牌桶限速（按GCRA记录每个桶的理论到达时间）：分别限制每秒请求数和章节数；
+    state_file不为空时桶的状态保存在文件中并用文件锁保护，同一台机器上的多个下载进程共用"""
+
+    def __init__(self, requests_per_second, chapters_per_second, burst, state_file=None):
+        self.rates = (requests_per_second, chapters_per_second)
+        self.burst = burst
+        self.arrivals = [0.0, 0.0]  # 每个桶的理论到达时间，早于当前时间说明桶是满的
+        self.lock = threading.Lock()
+        self.file = None
+        if state_file:
+            try:
+                os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
+                self.file = os.fdopen(os.open(state_file, os.O_RDWR | os.O_CREAT), "r+b")
+            except OSError as e:
+                print_once(f"限速状态文件不可用，只在本进程内限速: {e}", "rate_limit")
+
+    def reserve(self, requests=1, chapters=0):
+        """预约令牌并返回需要等待的秒数；令牌不足时先记账，由调用方等待，多个调用方依次排队"""
+        with self.lock:
+            if self.file is None:
+                return self.take(requests, chapters)
+            try:
+                with locked_file(self.file):
+                    self.load()
+                    wait = self.take(requests, chapters)
+                    self.save()
+                return wait
+            except OSError as e:
+                print_once(f"读写限速状态文件失败，只在本进程内限速: {e}", "rate_limit")
+                self.file = None
+                return self.take(requests, chapters)
+
+    def take(self, requests, chapters):
+        now = time.time()
+        wait = 0
+        for i, amount in enumerate((requests, chapters)):
+            rate = self.rates[i]
+            if rate <= 0 or amount <= 0:
+                continue
+            self.arrivals[i] = max(self.arrivals[i], now) + amount / rate
+            wait = max(wait, self.arrivals[i] - self.burst - now)
+        return wait
+
+    def load(self):
+        self.file.seek(0)
+        try:
+            values = [float(value) for value in self.file.read().split()]
+        except ValueError:
+            values = []
+        if len(values) == len(self.arrivals):
+            self.arrivals = values
+
+    def save(self):
+        self.file.seek(0)
+        self.file.write(" ".join(repr(value) for value in self.arrivals).encode("ascii"))
+        self.file.truncate()
+        self.file.flush()
+
+def get_rate_limiter():
+    """获取共享的限速器，未设置速率时返回None"""
+    global rate_limiter
+    config = CONFIG["rate_limit"]
+    if config["requests_per_second"] <= 0 and config["chapters_per_second"] <= 0:
+        return None
+    if rate_limiter is None:
+        with session_lock:
+            if rate_limiter is None:
+                rate_limiter = RateLimiter(config["requests_per_second"], config["chapters_per_second"],
+                                           config["burst"], config["state_file"] if config["shared"] else None)
+    return rate_limiter
+
+def wait_for_rate_limit(chapters=0):
+    """配置了限速时按一个请求和chapters（本次请求的章节数）预约令牌，不足时等待"""
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        wait = limiter.reserve(1, chapters)
+        if wait > 0:
+            with metrics.timed("rate_limit"):
+                time.sleep(wait)
+
+async def wait_for_rate_limit_async(chapters=0):
+    """wait_for_rate_limit的异步版本，等待时不阻塞事件循环"""
+    import asyncio
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        wait = limiter.reserve(1, chapters)
+        if wait > 0:
+            with metrics.timed("rate_limit"):
+                await asyncio.sleep(wait)
+
+def make_request(url, headers=None, params=None, data=None, method='GET', verify=False, timeout=None, stream=False,
+                 rate_limited=False):
+    """通用的请求函数，stream为True时只读取响应头，响应体由调用方按需读取
+
+    rate_limited为True表示调用方已经等过限速器，否则先按一个请求预约令牌
+    """
     if headers is None:
         headers = get_headers()
+
+    if not rate_limited:
+        wait_for_rate_limit()
     
     try:
         request_params = {
             'headers': headers,
             'params': params,
             'verify': verify,
-            'timeout': timeout if timeout is not None else CONFIG["request_timeout"]
+            'timeout': timeout if timeout is not None else CONFIG["request_timeout"],
+            'stream': stream
         }
         
         if data:
             request_params['json'] = data
 
-        session = requests.Session()
-        if method.upper() == 'GET':
-            response = session.get(url, **request_params)
-        elif method.upper() == 'POST':
-            response = session.post(url, **request_params)
-        else:
-            raise ValueError(f"不支持的HTTP方法: {method}")
+        session = get_session()
+        with metrics.timed("http_request"):
+            if method.upper() == 'GET':
+                response = session.get(url, **request_params)
+            elif method.upper() == 'POST':
+                response = session.post(url, **request_params)
+            else:
+                raise ValueError(f"不支持的HTTP方法: {method}")
         
         return response
     except Exception as e:
-        print_once(f"请求失败: {str(e)}")
+        print_once(f"请求失败: {str(e)}", "request_failed")
         raise
 
+def load_user_agent_pool():
+    """首次使用时生成UA轮换池，只加载一次UA数据"""
+    ua_config = CONFIG["user_agent"]
+    if ua_config["fixed"]:
+        return [ua_config["fixed"]]
+    if ua_config["offline"]:
+        return list(FALLBACK_USER_AGENTS)
+
+    try:
+        from fake_useragent import UserAgent
+        ua = UserAgent()
+        pool = set()
+        for _ in range(ua_config["pool_size"]):
+            pool.add(ua.chrome if random.random() < 0.5 else ua.edge)
+        if pool:
+            return list(pool)
+    except Exception as e:
+        print_once(f"加载UA数据失败，使用内置UA: {e}", "user_agent")
+    return list(FALLBACK_USER_AGENTS)
+
 def get_headers() -> Dict[str, str]:
     """生成随机请求头"""
-    browsers = ['chrome', 'edge']
-    browser = random.choice(browsers)
-    
-    if browser == 'chrome':
-        user_agent = UserAgent().chrome
-    else:
-        user_agent = UserAgent().edge
+    global user_agent_pool
+    if user_agent_pool is None:
+        with user_agent_lock:
+            if user_agent_pool is None:
+                user_agent_pool = load_user_agent_pool()
     
     return {
-        "User-Agent": user_agent,
+        "User-Agent": random.choice(user_agent_pool),
         "Accept": "application/json, text/javascript, */*; q=0.01",
         "Accept-Language": "zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7",
-        "Referer": "https://fanqienovel.com/",
+        "Referer": CONFIG["site_base"] + "/",
         "X-Requested-With": "XMLHttpRequest",
         "Content-Type": "application/json"
     }
 
-def batch_download_chapters_official(item_ids, headers):
-    """官方API批量下载章节内容"""
-    endpoint = CONFIG["official_api"]["batch_endpoint"]
-    max_batch_size = CONFIG["official_api"]["max_batch_size"]
-    results = {}
+class AdaptiveController:
+    """AIMD控制器：接口健康时逐步增大批量与并发，超时、失败或缺章时成倍回退"""
 
-    # 分批处理
-    for i in range(0, len(item_ids), max_batch_size):
-        batch_ids = item_ids[i:i + max_batch_size]
-        params = {'item_ids': ','.join(batch_ids)}
+    def __init__(self):
+        self.config = CONFIG["adaptive"]
+        self.batch_size = CONFIG["official_api"]["max_batch_size"]
+        self.concurrency = CONFIG["max_workers"]
+        self.failure_streak = 0
+        self.healthy_streak = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency, requested, received, ok):
+        """记录一次批量请求的结果并调整参数；未启用自适应时只记录连续失败次数，用于退避"""
+        if not self.config["enabled"]:
+            with self.lock:
+                self.failure_streak = 0 if ok else self.failure_streak + 1
+            return
+        config = self.config
+        with self.lock:
+            old = (self.batch_size, self.concurrency)
+            if not ok:
+                # 超时或非200：批量和并发减半
+                self.failure_streak += 1
+                self.healthy_streak = 0
+                self.batch_size = max(config["min_batch_size"], self.batch_size // 2)
+                self.concurrency = max(config["min_workers"], self.concurrency // 2)
+                reason = "失败"
+            elif received < requested:
+                # 部分章节缺失：只缩小批量，不累计退避
+                self.healthy_streak = 0
+                self.batch_size = max(config["min_batch_size"], self.batch_size * 3 // 4)
+                reason = "缺章"
+            elif latency > config["latency_target"]:
+                self.failure_streak = 0
+                self.healthy_streak = 0
+                self.batch_size = max(config["min_batch_size"], self.batch_size * 3 // 4)
+                reason = "变慢"
+            else:
+                self.failure_streak = 0
+                self.healthy_streak += 1
+                self.batch_size = min(config["max_batch_size"], self.batch_size + 2)
+                if self.healthy_streak % self.concurrency == 0:
+                    self.concurrency = min(config["max_workers"], self.concurrency + 1)
+                reason = "健康"
+            if (self.batch_size, self.concurrency) != old:
+                self.log(reason, latency, requested, received)
 
-        response = None
+    def log(self, reason, latency, requested, received):
+        log_file = self.config["log_file"]
+        if not log_file:
+            return
         try:
-            response = make_request(
-                endpoint,
-                headers=headers,
-                params=params,
-                timeout=CONFIG["official_api"]["timeout"],
-                verify=False
-            )
-        except Exception as e:
-            print_once(f"官方API批量请求异常（{endpoint}）: {str(e)}")
+            with open(log_file, 'a', encoding='utf-8') as f:
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')},{reason},{latency:.2f},{requested},{received},"
+                        f"{self.batch_size},{self.concurrency}\n")
+        except OSError:
+            pass
+
+    def retry_delay(self):
+        """带抖动的指数退避时间"""
+        with self.lock:
+            streak = self.failure_streak
+        cap = min(self.config["max_delay"], self.config["base_delay"] * (2 ** streak))
+        return random.uniform(cap / 2, cap)
+
+    def batch_pause(self):
+        """大批次之间的间隔：接口健康时不再等待（请求节奏由限速器控制），连续失败时退避"""
+        with self.lock:
+            streak = self.failure_streak
+        return self.retry_delay() if streak else 0
+
+    def summary(self):
+        return f"批量大小 {self.batch_size}，并发数 {self.concurrency}"
+
+def get_controller():
+    """获取共享的自适应控制器"""
+    global adaptive_controller
+    if adaptive_controller is None:
+        with session_lock:
+            if adaptive_controller is None:
+                adaptive_controller = AdaptiveController()
+    return adaptive_controller
+
+def get_worker_pool():
+    """获取所有书籍共用的批量请求线程池"""
+    global worker_pool
+    if worker_pool is None:
+        with session_lock:
+            if worker_pool is None:
+                worker_pool = ThreadPoolExecutor(max_workers=CONFIG["scheduler"]["max_inflight"])
+    return worker_pool
+
+def get_batch_slots():
+    """获取全局在途批量请求信号量"""
+    global batch_slots
+    if batch_slots is None:
+        with session_lock:
+            if batch_slots is None:
+                batch_slots = threading.BoundedSemaphore(CONFIG["scheduler"]["max_inflight"])
+    return batch_slots
+
+class HedgePolicy:
+    """对冲请求：批量请求超过近期耗时的分位数仍未返回时，再发一个相同的请求，取先成功的结果"""
+
+    def __init__(self):
+        self.config = CONFIG["hedge"]
+        self.latencies = deque(maxlen=200)
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def observe(self, latency):
+        """记录一次成功的批量请求耗时"""
+        with self.lock:
+            self.latencies.append(latency)
+
+    def delay(self):
+        """本次批量请求发出对冲前的等待秒数，未启用或样本不足时返回None"""
+        if not self.config["enabled"]:
+            return None
+        with self.lock:
+            self.requests += 1
+            if len(self.latencies) < self.config["min_samples"]:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.config["percentile"]))
+        return max(self.config["min_delay"], latencies[index])
+
+    def try_hedge(self):
+        """在额外负载上限内并且有空闲的在途请求名额时占用一个名额，由对冲请求结束时释放"""
+        with self.lock:
+            if self.hedges + 1 > self.requests * self.config["max_ratio"]:
+                return False
+            if not get_batch_slots().acquire(blocking=False):
+                return False
+            self.hedges += 1
+        metrics.count("hedge_sent")
+        return True
+
+def get_hedge_policy():
+    global hedge_policy
+    if hedge_policy is None:
+        with session_lock:
+            if hedge_policy is None:
+                hedge_policy = HedgePolicy()
+    return hedge_policy
+
+def get_hedge_pool():
+    """对冲时原请求与对冲请求在这个线程池中并行，调用方线程只等待结果"""
+    global hedge_pool
+    if hedge_pool is None:
+        with session_lock:
+            if hedge_pool is None:
+                hedge_pool = ThreadPoolExecutor(max_workers=CONFIG["scheduler"]["max_inflight"] * 2)
+    return hedge_pool
+
+def load_json(data):
+    """解析JSON文本或字节，安装了orjson时使用orjson，orjson拒绝的输入（如NaN）退回标准库"""
+    global json_loads
+    if json_loads is None:
+        try:
+            import orjson
+            json_loads = orjson.loads
+        except ImportError:
+            json_loads = json.loads
+    try:
+        return json_loads(data)
+    except ValueError:
+        if json_loads is json.loads:
+            raise
+        return json.loads(data)
+
+class ChapterStreamParser:
+    """增量解析批量接口返回的 {章节id: {title, content}} 对象，每收到一段数据就产出其中已完整的章节"""
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""  # 尚未解析完的部分
+        self.offset = 0  # buffer开头在整个响应中的位置，用于错误信息
+        self.chunks = []
+        self.size = 0
+        self.retry_at = 0  # 未完整的章节要等数据量翻倍后再尝试解析，避免每收到一段都从头解析
+        self.state = "start"  # start → key ⇄ next → end；顶层不是对象时为ignore
+
+    def feed(self, data):
+        """接收一段字节，返回其中已完整的 (章节id, 内容) 列表"""
+        text = self.text.decode(data)
+        if self.state == "ignore" or not text:
+            return []
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size < self.retry_at:
+            return []
+        return self.parse(False)
+
+    def close(self):
+        """数据接收完毕，返回剩余的章节；响应不完整时抛出ValueError"""
+        self.chunks.append(self.text.decode(b"", final=True))
+        pairs = self.parse(True)
+        if self.state not in ("end", "ignore"):
+            raise ValueError("批量接口响应不完整")
+        return pairs
+
+    def parse(self, final):
+        buffer = self.buffer + "".join(self.chunks)
+        self.chunks = []
+        skip = json.decoder.WHITESPACE.match
+        end = len(buffer)
+        pos = 0
+        pairs = []
+        while self.state != "ignore":
+            pos = skip(buffer, pos).end()
+            if pos == end:
+                break
+            char = buffer[pos]
+            if self.state == "start":
+                if char != "{":
+                    # 错误信息等非对象响应，不含章节
+                    self.state = "ignore"
+                    break
+                self.state = "key"
+                pos += 1
+            elif self.state == "end":
+                raise ValueError(f"批量接口响应在位置 {self.offset + pos} 之后有多余内容")
+            elif char == "}":
+                self.state = "end"
+                pos += 1
+            elif self.state == "next":
+                if char != ",":
+                    raise ValueError(f"批量接口响应在位置 {self.offset + pos} 缺少逗号")
+                self.state = "key"
+                pos += 1
+            else:
+                # 键和值一起解析，值还没收完时下次从键重新开始
+                try:
+                    key, key_end = self.decoder.raw_decode(buffer, pos)
+                    colon = skip(buffer, key_end).end()
+                    if colon == end:
+                        break
+                    if not isinstance(key, str) or buffer[colon] != ":":
+                        raise ValueError(f"批量接口响应在位置 {self.offset + pos} 格式错误")
+                    value, value_end = self.decoder.raw_decode(buffer, skip(buffer, colon + 1).end())
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                if not final and (value_end == end or (
+                        type(value) in (int, float) and buffer[value_end] not in " \t\n\r,}")):
+                    # 数字可能被截在中间（如"1."只解析出1），后面是分隔符时才算完整
+                    break
+                pairs.append((key, value))
+                self.state = "next"
+                pos = value_end
+        self.buffer = buffer[pos:] if self.state != "ignore" else ""
+        self.offset += pos
+        self.size = len(self.buffer)
+        self.retry_at = self.size * 2
+        return pairs
+
+def read_batch_response(response):
+    """逐个产出批量响应中的 (章节id, 内容)，流式模式下边下载边解析"""
+    try:
+        if not CONFIG["official_api"]["stream"]:
+            data = load_json(response.content)
+            if isinstance(data, dict):
+                yield from data.items()
+            return
+        parser = ChapterStreamParser()
+        for chunk in response.iter_content(CONFIG["official_api"]["stream_chunk_size"]):
+            yield from parser.feed(chunk)
+        yield from parser.close()
+    finally:
+        response.close()
+
+def request_batch_once(batch_ids, headers, slot_held=False):
+    """向负载最低的实例请求一批章节，返回 (响应, 实例地址, 异常)；限速由调用方在占用名额前处理"""
+    # 先占用全局名额再选实例，等待名额的请求不计入实例的在途请求数
+    slots = get_batch_slots()
+    if not slot_held:
+        slots.acquire()
+    backends = get_api_backends()
+    backend = backends.acquire()
+    try:
+        response = make_request(
+            backend["endpoint"],
+            headers=headers,
+            params={'item_ids': ','.join(batch_ids)},
+            timeout=CONFIG["official_api"]["timeout"],
+            verify=False,
+            stream=CONFIG["official_api"]["stream"],
+            rate_limited=True
+        )
+        backends.release(backend)
+        return response, backend["endpoint"], None
+    except Exception as e:
+        # 超时或连接失败的实例会被暂时摘除
+        backends.release(backend, healthy=False)
+        return None, backend["endpoint"], e
+    finally:
+        slots.release()
+
+def discard_hedge_loser(future):
+    """落后的请求无法中断，返回后丢弃响应，连接回到连接池"""
+    response = future.result()[0]
+    if response is not None:
+        response.close()
+
+def request_batch(batch_ids, headers):
+    """请求一批章节，启用对冲时超过等待时间再发一个相同的请求，返回先成功的结果
+
+    对冲请求已由对冲预算限制数量，不再经过限速器
+    """
+    hedge = get_hedge_policy()
+    delay = hedge.delay()
+    if delay is None:
+        return request_batch_once(batch_ids, headers)
+    primary = get_hedge_pool().submit(request_batch_once, batch_ids, headers)
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+    if not hedge.try_hedge():
+        return primary.result()
+    secondary = get_hedge_pool().submit(request_batch_once, batch_ids, headers, True)
+    failed = []  # 已返回但失败的请求
+    for future in as_completed((primary, secondary)):
+        outcome = future.result()
+        if outcome[0] is not None and outcome[0].status_code == 200:
+            if future is secondary:
+                metrics.count("hedge_won")
+            loser = secondary if future is primary else primary
+            if loser in failed:
+                discard_hedge_loser(loser)
+            else:
+                loser.add_done_callback(discard_hedge_loser)
+            return outcome
+        failed.append(future)
+    # 都失败时返回先到的结果，关闭另一个的响应
+    discard_hedge_loser(failed[1])
+    return failed[0].result()
+
+def batch_download_chapters_official(item_ids, headers, on_chapter):
+    """官方API批量下载章节内容，多实例时每批选择负载最低的实例；
+    解析出一章就调用on_chapter(章节id, 内容)，返回收到的章节数"""
+    controller = get_controller()
+    hedge = get_hedge_policy()
+    delivered = 0
+
+    # 分批处理
+    i = 0
+    while i < len(item_ids):
+        batch_ids = item_ids[i:i + controller.batch_size]
+        i += len(batch_ids)
+
+        # 限速等待不计入批量请求的耗时，以免控制器误判实例变慢
+        wait_for_rate_limit(len(batch_ids))
+        started = time.time()
+        with metrics.timed("batch_request"):
+            response, endpoint, error = request_batch(batch_ids, headers)
+        if error is not None:
+            controller.record(time.time() - started, len(batch_ids), 0, False)
+            print_once(f"官方API批量请求异常（{endpoint}）: {str(error)}", "batch_exception")
+            report_api_log(endpoint)
             continue
 
         if response is None:
-            print_once("官方API批量下载失败")
+            print_once("官方API批量下载失败", "batch_failed")
             continue
 
         if response.status_code == 200:
+            # 官方API返回的是字典，键是章节id，值是包含title和content的对象
+            wanted = set(batch_ids)
+            seen = set()
+            received = 0
             try:
-                data = response.json()
+                for chapter_id, entry in read_batch_response(response):
+                    if chapter_id not in wanted:
+                        continue
+                    seen.add(chapter_id)
+                    if isinstance(entry, dict) and entry.get("content"):
+                        received += 1
+                    on_chapter(chapter_id, entry)
             except Exception as e:
-                print_once(f"解析官方API响应 JSON 失败（{endpoint}）: {e}")
+                delivered += len(seen)
+                controller.record(time.time() - started, len(batch_ids), received, False)
+                print_once(f"解析官方API响应 JSON 失败（{endpoint}）: {e}", "batch_json")
                 continue
 
-            # 官方API返回的是字典，键是章节id，值是包含title和content的对象
+            delivered += len(seen)
             for chapter_id in batch_ids:
-                if chapter_id in data:
-                    results[chapter_id] = data[chapter_id]
-                else:
-                    print_once(f"章节 {chapter_id} 不在批量下载中！")
+                if chapter_id not in seen:
+                    print_once(f"章节 {chapter_id} 不在批量下载中！", "chapter_missing")
+            controller.record(time.time() - started, len(batch_ids), received, True)
+            hedge.observe(time.time() - started)
         else:
-            print_once(f"官方API批量下载失败，状态码: {response.status_code}")
+            controller.record(time.time() - started, len(batch_ids), 0, False)
+            print_once(f"官方API批量下载失败，状态码: {response.status_code}", "batch_status")
+            report_api_log(endpoint)
             try:
                 txt = response.text
-                print_once(f"响应内容片段: {txt[:300]}...")
+                print_once(f"响应内容片段: {txt[:300]}...", None)
             except Exception:
                 pass
 
-    return results
+    return delivered
+
+# 段落之间的分隔，改为 "\n\n" 可在段落间多空一行
+PARAGRAPH_SEPARATOR = "\n"
+
+# 章节内容清洗用到的正则，预编译一次
+PARAGRAPH_OPEN_PATTERN = re.compile(r'<p idx="\d+">')
+HEADER_PATTERN = re.compile(r'<header>.*?</header>', re.DOTALL)
+FOOTER_PATTERN = re.compile(r'<footer>.*?</footer>', re.DOTALL)
+ARTICLE_PATTERN = re.compile(r'</?article>')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+ESCAPED_BRACKET_PATTERN = re.compile(r'\\u003c|\\u003e')
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+LEADING_SPACE_PATTERN = re.compile(r'^(\s*)', re.MULTILINE)
+LINE_INDENT_PATTERN = re.compile(r'^[^\S\n]*(?=\S)', re.MULTILINE)
+
+def split_paragraphs(content):
+    """切出 <p idx="数字">...</p> 中的段落，与 re.findall(r'<p idx="\\d+">(.*?)</p>', content, re.DOTALL) 结果一致"""
+    paragraphs = []
+    pos = content.find('<p idx="')
+    while pos != -1:
+        opening = PARAGRAPH_OPEN_PATTERN.match(content, pos)
+        if not opening:
+            pos = content.find('<p idx="', pos + 1)
+            continue
+        end = content.find('</p>', opening.end())
+        if end == -1:
+            break
+        paragraphs.append(content[opening.end():end])
+        pos = content.find('<p idx="', end + 4)
+    return paragraphs
 
 def process_chapter_content(content):
-    """处理章节内容"""
+    """处理章节内容，返回每段首行缩进后的正文"""
     if not content or not isinstance(content, str):
         return ""
     
     try:
-        paragraphs = []
         if '<p idx=' in content:
-            paragraphs = re.findall(r'<p idx="\d+">(.*?)</p>', content, re.DOTALL)
+            paragraphs = split_paragraphs(content)
         else:
             paragraphs = content.split('\n')
-        
-        if paragraphs:
-            first_para = paragraphs[0].strip()
-            if not first_para.startswith('　　'):
-                paragraphs[0] = '　　' + first_para
-        
-        cleaned_content = "\n".join(p.strip() for p in paragraphs if p.strip())
-        formatted_content = '\n'.join('　　' + line if line.strip() else line 
-                                    for line in cleaned_content.split('\n'))
-        
-        formatted_content = re.sub(r'<header>.*?</header>', '', formatted_content, flags=re.DOTALL)
-        formatted_content = re.sub(r'<footer>.*?</footer>', '', formatted_content, flags=re.DOTALL)
-        formatted_content = re.sub(r'</?article>', '', formatted_content)
-        formatted_content = re.sub(r'<[^>]+>', '', formatted_content)
-        formatted_content = re.sub(r'\\u003c|\\u003e', '', formatted_content)
-        
-        # 压缩多余的空行
-        formatted_content = re.sub(r'\n{3,}', '\n\n', formatted_content).strip()
-        return formatted_content
+
+        # 常见情况：段落内没有换行和残留标签，一次拼接即可得到结果
+        lines = [line for line in (p.strip() for p in paragraphs) if line]
+        body = (PARAGRAPH_SEPARATOR + '　　').join(lines)
+        expected_newlines = (len(lines) - 1) * PARAGRAPH_SEPARATOR.count('\n')
+        if body.count('\n') == expected_newlines and '<' not in body and '\\u003' not in body:
+            return '　　' + body
+
+        return clean_chapter_markup(paragraphs)
     except Exception as e:
         with print_lock:
             print(f"内容处理错误: {str(e)}")
         return str(content)
 
-def get_chapters_from_api(book_id, headers):
-    """从API获取章节id/title"""
-    try:
-        api_url = f"https://fanqienovel.com/api/reader/directory/detail?bookId={book_id}"
-        api_response = requests.get(api_url, headers=headers, timeout=CONFIG["request_timeout"])
-        api_data = api_response.json()
-        chapter_ids = api_data.get("data", {}).get("allItemIds", [])
+def clean_chapter_markup(paragraphs):
+    """段落内含换行或标签时逐步清洗"""
+    cleaned_content = PARAGRAPH_SEPARATOR.join(p.strip() for p in paragraphs if p.strip())
+    formatted_content = '\n'.join('　　' + line if line.strip() else line
+                                  for line in cleaned_content.split('\n'))
+    
+    formatted_content = HEADER_PATTERN.sub('', formatted_content)
+    formatted_content = FOOTER_PATTERN.sub('', formatted_content)
+    formatted_content = ARTICLE_PATTERN.sub('', formatted_content)
+    formatted_content = TAG_PATTERN.sub('', formatted_content)
+    formatted_content = ESCAPED_BRACKET_PATTERN.sub('', formatted_content)
+    
+    # 压缩多余的空行
+    formatted_content = BLANK_LINES_PATTERN.sub('\n\n', formatted_content).strip()
+    if PARAGRAPH_SEPARATOR != "\n":
+        # 自定义了段落间距时保留空行，只替换每行开头的空白
+        return LINE_INDENT_PATTERN.sub('　　', formatted_content)
+    return LEADING_SPACE_PATTERN.sub('　　', formatted_content)
 
-        api_titles = {}
-        if chapter_ids:
-            try:
-                api_titles = batch_download_chapters_official(chapter_ids, headers)
-            except Exception:
-                api_titles = {}
-
-        final_chapters = []
-        for idx, chapter_id in enumerate(chapter_ids):
-            title = ""
-            if chapter_id in api_titles and isinstance(api_titles[chapter_id], dict):
-                title = api_titles[chapter_id].get("title", "")
-            if not title:
-                title = f"第{idx+1}章"
-            final_chapters.append({
-                "id": chapter_id,
-                "title": title,
-                "index": idx
-            })
-
-        return final_chapters
+def parse_directory_titles(api_data):
+    """从目录接口的分卷列表中提取章节标题"""
+    titles = {}
+    volumes = api_data.get("data", {}).get("chapterListWithVolume") or []
+    for volume in volumes:
+        if not isinstance(volume, list):
+            continue
+        for item in volume:
+            if isinstance(item, dict) and item.get("itemId") and item.get("title"):
+                titles[str(item["itemId"])] = item["title"]
+    return titles
+
+def parse_chapter_directory(response):
+    """解析目录接口的响应，返回章节列表 [{"id", "title", "index"}]，没有章节时返回None"""
+    api_data = load_json(response.content)
+    chapter_ids = api_data.get("data", {}).get("allItemIds", [])
+
+    # 目录接口自带标题；缺失的先用序号占位，下载正文时会被正文接口的标题替换
+    api_titles = parse_directory_titles(api_data)
+
+    final_chapters = []
+    for idx, chapter_id in enumerate(chapter_ids):
+        title = api_titles.get(str(chapter_id), "")
+        if not title:
+            title = f"第{idx+1}章"
+        final_chapters.append({
+            "id": chapter_id,
+            "title": title,
+            "index": idx
+        })
+
+    return final_chapters or None
+
+def get_chapters_from_api(book_id, headers, revalidate=False):
+    """从目录接口获取章节id/title，不下载正文；revalidate为True时不直接使用缓存，总是向服务器确认"""
+    try:
+        api_url = f"{CONFIG['site_base']}/api/reader/directory/detail?bookId={book_id}"
+        ttl = 0 if revalidate else CONFIG["metadata_cache"]["directory_ttl"]
+        return fetch_metadata(book_id, "directory", api_url, headers, parse_chapter_directory, ttl)
     except Exception as e:
         with print_lock:
             print(f"获取章节列表失败: {str(e)}")
         return None
 
-def create_epub_book(name, author_name, description, chapter_results, chapters):
-    """创建EPUB文件"""
-    book = epub.EpubBook()
-    book.set_identifier(f'book_{name}_{int(time.time())}')
-    book.set_title(name)
-    book.set_language('zh-CN')
-    book.add_author(author_name)
-    book.add_metadata('DC', 'description', description)
-    
-    book.toc = []
-    spine = ['nav']
-    
-    for idx in range(len(chapters)):
-        if idx in chapter_results:
-            result = chapter_results[idx]
-            title = result["api_title"] if result["api_title"] else result["base_title"]
-            chapter = epub.EpubHtml(
-                title=title,
-                file_name=f'chap_{idx}.xhtml',
-                lang='zh-CN'
-            )
-            content = result['content'].replace('\n', '<br/>')
-            chapter.content = f'<h1>{title}</h1><p>{content}</p>'.encode('utf-8')
-            book.add_item(chapter)
-            book.toc.append(chapter)
-            spine.append(chapter)
-    
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = spine
+EPUB_CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>"""
+
+def render_epub_chapter(title, content):
+    """生成章节XHTML正文片段"""
+    content = html.escape(content, quote=False).replace('\n', '<br/>')
+    return f'<h1>{html.escape(title, quote=False)}</h1><p>{content}</p>'.encode('utf-8')
+
+class StreamingEpubWriter:
+    """单个EPUB文件的流式写入：章节写入zip后即释放，只在内存中保留目录信息"""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        # mimetype必须是第一个且不压缩
+        self.zip.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml', EPUB_CONTAINER_XML)
+        self.chapters = []  # (文件名, 标题)
+        self.bytes = 0
+
+    def add(self, title, fragment):
+        """按顺序写入一个章节"""
+        file_name = f'chap_{len(self.chapters) + 1}.xhtml'
+        escaped_title = html.escape(title, quote=False)
+        page = (f'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+                f'<html xmlns="http://www.w3.org/1999/xhtml" lang="zh-CN" xml:lang="zh-CN">'
+                f'<head><title>{escaped_title}</title></head><body>').encode('utf-8') + fragment + b'</body></html>'
+        self.zip.writestr(f'OEBPS/{file_name}', page)
+        self.chapters.append((file_name, escaped_title))
+        self.bytes += len(page)
+
+    def close(self, title, author_name, description):
+        """写入目录与元数据并完成文件"""
+        title, author_name, description = (html.escape(text, quote=False) for text in (title, author_name, description))
+        identifier = f"book_{title}_{int(time.time())}"
+        nav_points = ''.join(
+            f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>{chapter_title}</text></navLabel>'
+            f'<content src="{file_name}"/></navPoint>'
+            for i, (file_name, chapter_title) in enumerate(self.chapters, 1))
+        self.zip.writestr('OEBPS/toc.ncx', (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head><meta name="dtb:uid" content="{identifier}"/></head>'
+            f'<docTitle><text>{title}</text></docTitle><navMap>{nav_points}</navMap></ncx>'))
+        nav_items = ''.join(f'<li><a href="{file_name}">{chapter_title}</a></li>'
+                            for file_name, chapter_title in self.chapters)
+        self.zip.writestr('OEBPS/nav.xhtml', (
+            '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh-CN" xml:lang="zh-CN">'
+            f'<head><title>{title}</title></head><body><nav epub:type="toc" id="toc"><h2>{title}</h2>'
+            f'<ol>{nav_items}</ol></nav></body></html>'))
+        manifest = ''.join(f'<item id="{file_name[:-6]}" href="{file_name}" media-type="application/xhtml+xml"/>'
+                           for file_name, _ in self.chapters)
+        spine = ''.join(f'<itemref idref="{file_name[:-6]}"/>' for file_name, _ in self.chapters)
+        self.zip.writestr('OEBPS/content.opf', (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id" xml:lang="zh-CN">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="id">{identifier}</dc:identifier><dc:title>{title}</dc:title>'
+            f'<dc:language>zh-CN</dc:language><dc:creator>{author_name}</dc:creator>'
+            f'<dc:description>{description}</dc:description>'
+            f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>'
+            '</metadata><manifest>'
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            f'{manifest}</manifest><spine toc="ncx"><itemref idref="nav"/>{spine}</spine></package>'))
+        self.zip.close()
+
+def render_chapter(file_format, title, content, processed=None):
+    """清洗并渲染章节，返回(清洗后的正文, 渲染结果, 清洗耗时)：txt为文本块，epub为XHTML
     
-    return book
+    可能在子进程中运行，清洗耗时随结果返回，由主进程计入指标
+    """
+    clean_seconds = None
+    if processed is None:
+        started = time.perf_counter()
+        processed = process_chapter_content(content)
+        clean_seconds = time.perf_counter() - started
+    if file_format == 'epub':
+        return processed, render_epub_chapter(title, processed), clean_seconds
+    return processed, f"{title}\n{processed}\n\n", clean_seconds
+
+class ChapterCache:
+    """本地章节缓存：按item_id保存原始与清洗后的正文（zlib压缩），超出容量按LRU淘汰"""
+
+    def __init__(self, path, max_bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS chapters (
+            item_id TEXT PRIMARY KEY,
+            title TEXT,
+            raw BLOB,
+            cleaned BLOB,
+            size INTEGER,
+            accessed REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS chapters_accessed ON chapters (accessed)")
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM chapters").fetchone()[0]
+
+    def get_many(self, item_ids):
+        """批量读取缓存，返回 {item_id: {"title", "content", "cleaned"}}"""
+        results = {}
+        with self.lock:
+            for i in range(0, len(item_ids), 500):
+                chunk = item_ids[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT item_id, title, raw, cleaned FROM chapters WHERE item_id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                for item_id, title, raw, cleaned in rows:
+                    results[item_id] = {
+                        "title": title,
+                        "content": zlib.decompress(raw).decode('utf-8'),
+                        "cleaned": zlib.decompress(cleaned).decode('utf-8') if cleaned else None
+                    }
+            if results:
+                now = time.time()
+                self.db.executemany("UPDATE chapters SET accessed = ? WHERE item_id = ?",
+                                    [(now, item_id) for item_id in results])
+                self.db.commit()
+        return results
+
+    def put(self, item_id, title, content, cleaned=None):
+        """写入一个章节"""
+        raw = zlib.compress(content.encode('utf-8'))
+        cleaned_blob = zlib.compress(cleaned.encode('utf-8')) if cleaned is not None else None
+        size = len(raw) + (len(cleaned_blob) if cleaned_blob else 0)
+        with self.lock:
+            old = self.db.execute("SELECT size FROM chapters WHERE item_id = ?", (item_id,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?, ?)",
+                            (item_id, title, raw, cleaned_blob, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """淘汰最久未使用的章节，直到缓存降到容量的90%"""
+        target = self.max_bytes * 0.9
+        rows = self.db.execute("SELECT item_id, size FROM chapters ORDER BY accessed").fetchall()
+        removed = []
+        for item_id, size in rows:
+            if self.total_bytes <= target:
+                break
+            removed.append((item_id,))
+            self.total_bytes -= size
+        self.db.executemany("DELETE FROM chapters WHERE item_id = ?", removed)
+
+def get_chapter_cache():
+    """获取本地章节缓存，未启用或无法打开时返回None"""
+    global chapter_cache
+    cache_config = CONFIG["cache"]
+    if not cache_config["enabled"]:
+        return None
+    if chapter_cache is None:
+        with session_lock:
+            if chapter_cache is None:
+                try:
+                    chapter_cache = ChapterCache(cache_config["path"], cache_config["max_bytes"])
+                except (OSError, sqlite3.Error) as e:
+                    print_once(f"章节缓存不可用: {e}", "cache")
+                    cache_config["enabled"] = False
+                    return None
+    return chapter_cache
+
+class MetadataCache:
+    """书籍元数据缓存：按书籍id保存解析后的目录和书籍信息，以及服务器返回的ETag/Last-Modified"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+            book_id TEXT,
+            kind TEXT,
+            data TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            fetched REAL,
+            PRIMARY KEY (book_id, kind))""")
+
+    def get(self, book_id, kind):
+        """读取一项缓存，返回 {"data", "etag", "last_modified", "fetched"}，没有时返回None"""
+        with self.lock:
+            row = self.db.execute("SELECT data, etag, last_modified, fetched FROM metadata WHERE book_id = ? AND kind = ?",
+                                  (book_id, kind)).fetchone()
+        if row is None:
+            return None
+        try:
+            data = json.loads(row[0])
+        except ValueError:
+            return None
+        return {"data": data, "etag": row[1], "last_modified": row[2], "fetched": row[3]}
+
+    def put(self, book_id, kind, data, etag=None, last_modified=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                            (book_id, kind, json.dumps(data, ensure_ascii=False), etag, last_modified, time.time()))
+            self.db.commit()
+
+    def touch(self, book_id, kind):
+        """服务器确认未修改，重新开始计算缓存时间"""
+        with self.lock:
+            self.db.execute("UPDATE metadata SET fetched = ? WHERE book_id = ? AND kind = ?", (time.time(), book_id, kind))
+            self.db.commit()
+
+def get_metadata_cache():
+    """获取元数据缓存，未启用或无法打开时返回None"""
+    global metadata_cache
+    cache_config = CONFIG["metadata_cache"]
+    if not cache_config["enabled"]:
+        return None
+    if metadata_cache is None:
+        with session_lock:
+            if metadata_cache is None:
+                try:
+                    metadata_cache = MetadataCache(cache_config["path"])
+                except (OSError, sqlite3.Error) as e:
+                    print_once(f"元数据缓存不可用: {e}", "metadata_cache")
+                    cache_config["enabled"] = False
+                    return None
+    return metadata_cache
+
+def fetch_metadata(book_id, kind, url, headers, parse, ttl):
+    """请求目录或书籍页面并缓存parse(response)的结果（为None时不缓存）：
+    缓存不超过ttl秒时直接使用，过期后发送条件请求，服务器返回304时不再下载和解析"""
+    cache = get_metadata_cache()
+    entry = None
+    if cache is not None:
+        try:
+            entry = cache.get(book_id, kind)
+        except sqlite3.Error as e:
+            print_once(f"读取元数据缓存失败: {e}", "metadata_cache")
+    if entry is not None and time.time() - entry["fetched"] < ttl:
+        metrics.count("metadata_cache_fresh")
+        return entry["data"]
+
+    request_headers = dict(headers)
+    if entry is not None:
+        if entry["etag"]:
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+    response = make_request(url, headers=request_headers, verify=True)
+    if response.status_code == 304 and entry is not None:
+        metrics.count("metadata_not_modified")
+        try:
+            cache.touch(book_id, kind)
+        except sqlite3.Error:
+            pass
+        return entry["data"]
+
+    data = parse(response)
+    if data is not None and cache is not None:
+        try:
+            cache.put(book_id, kind, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        except sqlite3.Error as e:
+            print_once(f"写入元数据缓存失败: {e}", "metadata_cache")
+    return data
+
+def get_process_pool():
+    """获取共享的清洗进程池，未启用时返回None"""
+    global process_pool
+    processes = CONFIG["pipeline"]["processes"]
+    if processes <= 0:
+        return None
+    if process_pool is None:
+        with session_lock:
+            if process_pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                process_pool = ProcessPoolExecutor(max_workers=processes)
+    return process_pool
+
+class ChapterPipeline:
+    """下载后的处理流水线：清洗/渲染 → 写入，各阶段之间用有界队列连接，不阻塞网络请求"""
+
+    CHECKPOINT = object()
+    STOP = object()
+    SKIP = object()
+
+    def __init__(self, writer, file_format, on_written, on_checkpoint):
+        self.writer = writer
+        self.file_format = file_format
+        self.on_written = on_written
+        self.on_checkpoint = on_checkpoint
+        self.pool = get_process_pool()
+        self.cache = get_chapter_cache()
+        queue_size = CONFIG["pipeline"]["queue_size"]
+        self.render_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.render_thread = threading.Thread(target=self.render_loop, daemon=True)
+        self.write_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.closed = False
+        self.error = None  # 某个阶段出错时记录异常，之后的提交和关闭都会抛出它
+        self.render_thread.start()
+        self.write_thread.start()
+
+    def check(self):
+        """某个阶段出错时抛出该异常"""
+        if self.error is not None:
+            raise self.error
+
+    def fail(self, error):
+        # 出错的阶段继续排空队列，提交方不会因队列满而一直阻塞
+        if self.error is None:
+            self.error = error
+
+    def put(self, item):
+        """放入渲染队列，队列满时等待以形成背压；流水线已关闭（如中断时）或出错时不再等待而是抛出异常"""
+        while True:
+            self.check()
+            if self.closed:
+                raise RuntimeError("处理流水线已关闭")
+            try:
+                self.render_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def submit(self, chap, title, content, processed=None):
+        """提交一个章节（缓存命中时附带清洗后的正文）"""
+        self.put((chap, title, content, processed))
+
+    def checkpoint(self):
+        """在此之前提交的章节写入后保存进度"""
+        self.put(self.CHECKPOINT)
+
+    def skip(self, chap):
+        """放弃一个章节，写入阶段不再等待它"""
+        self.put((self.SKIP, chap))
+
+    def render_loop(self):
+        # 使用进程池时保持有限个在途任务，并按提交顺序交给写入阶段
+        in_flight = []
+        window = max(1, CONFIG["pipeline"]["processes"] * 2)
+        while True:
+            item = self.render_queue.get()
+            if self.error is not None and item is not self.STOP:
+                continue
+            try:
+                if item is self.STOP or item is self.CHECKPOINT or item[0] is self.SKIP:
+                    for job in in_flight:
+                        self.finish(*job)
+                    in_flight = []
+                    self.write_queue.put(item)
+                    if item is self.STOP:
+                        return
+                    continue
+
+                chap, title, content, processed = item
+                if self.pool is None or processed is not None:
+                    self.finish(chap, title, content, processed)
+                    continue
+                in_flight.append((chap, title, content, None,
+                                  self.pool.submit(render_chapter, self.file_format, title, content)))
+                while in_flight and (len(in_flight) >= window or in_flight[0][4].done()):
+                    self.finish(*in_flight.pop(0))
+            except Exception as e:
+                self.fail(e)
+                in_flight = []
+                if item is self.STOP:
+                    self.write_queue.put(item)
+                    return
+
+    def finish(self, chap, title, content, processed, future=None):
+        """取出渲染结果交给写入阶段，进程池出错时退回当前线程处理"""
+        result = None
+        if future is not None:
+            try:
+                result = future.result()
+            except Exception as e:
+                print_once(f"进程池处理章节失败，改为线程处理: {e}", "process_pool")
+        if result is None:
+            result = render_chapter(self.file_format, title, content, processed)
+        if result[2] is not None:
+            metrics.observe("clean", result[2])
+        if processed is None and self.cache is not None:
+            # 新下载的章节写入缓存，之后换格式导出或重新下载时直接使用
+            try:
+                self.cache.put(chap["id"], title, content, result[0])
+            except sqlite3.Error as e:
+                print_once(f"写入章节缓存失败: {e}", "cache")
+        self.write_queue.put((chap, title, result[1]))
+
+    def write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is self.STOP:
+                return
+            if self.error is not None:
+                continue
+            try:
+                if item is self.CHECKPOINT:
+                    self.writer.flush()
+                    self.on_checkpoint()
+                    continue
+                if item[0] is self.SKIP:
+                    self.on_written(self.writer.skip(item[1]["index"]))
+                    continue
+                chap, title, rendered = item
+                with metrics.timed("write"):
+                    written = self.writer.add(chap["index"], chap["id"], title, rendered)
+                self.on_written(written)
+            except Exception as e:
+                self.fail(e)
+
+    def close(self):
+        """处理完队列中的章节并停止各阶段"""
+        if self.closed:
+            return
+        self.closed = True
+        self.render_queue.put(self.STOP)
+        self.render_thread.join()
+        self.write_thread.join()
+        # 关闭时正在提交的章节可能排在STOP之后，清空以免占用内存
+        while True:
+            try:
+                self.render_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.check()
+
+class PendingChapter:
+    """重排缓冲区中的一个章节：正文为zlib压缩的UTF-8，溢出到临时文件时只记录偏移和长度"""
+
+    __slots__ = ("chapter_id", "data", "offset", "length")
+
+    def __init__(self, chapter_id, data):
+        self.chapter_id = chapter_id
+        self.data = data
+        self.offset = None
+        self.length = len(data)
+
+class ReorderBuffer:
+    """乱序到达、等待前面章节的已渲染章节：压缩后保存在内存，超过上限后写入临时文件"""
+
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.entries = {}  # index -> PendingChapter，放弃的章节为None
+        self.memory_bytes = 0
+        self.spilled = 0
+        self.spill_file = None
+
+    def __contains__(self, index):
+        return index in self.entries
+
+    def put(self, index, chapter_id, data):
+        entry = PendingChapter(chapter_id, zlib.compress(data, 1))
+        if self.memory_bytes + entry.length > self.memory_limit:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile()
+            self.spill_file.seek(0, os.SEEK_END)
+            entry.offset = self.spill_file.tell()
+            self.spill_file.write(entry.data)
+            entry.data = None
+            self.spilled += 1
+        else:
+            self.memory_bytes += entry.length
+        self.entries[index] = entry
+
+    def skip(self, index):
+        self.entries[index] = None
+
+    def pop(self, index):
+        """取出一个章节，返回 (章节id, UTF-8编码的文本)，放弃的章节返回None"""
+        entry = self.entries.pop(index)
+        if entry is None:
+            return None
+        if entry.offset is None:
+            self.memory_bytes -= entry.length
+            data = entry.data
+        else:
+            self.spill_file.seek(entry.offset)
+            data = self.spill_file.read(entry.length)
+            self.spilled -= 1
+            if not self.spilled:
+                # 溢出的章节都已取出，清空临时文件以回收空间
+                self.spill_file.truncate(0)
+        return entry.chapter_id, zlib.decompress(data)
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+class TxtChapterWriter:
+    """TXT增量写入：章节按顺序追加，乱序到达的章节先放入重排缓冲区
+
+    有章节要写在已写入的章节之前时（之前放弃的章节、目录中间插入的新章节），按目录顺序重建整个文件：
+    已有的章节按偏移索引从原文件复制，完成后原子替换，新章节在替换后才记入进度
+    """
+
+    def __init__(self, path, header, chapters, todo, done=()):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.order = [chap["index"] for chap in todo]  # 待写入章节的index顺序，重建时还包括原文件中的章节
+        self.cursor = 0
+        self.pending = ReorderBuffer(CONFIG["pipeline"]["reorder_memory"])
+        self.output_paths = [path]
+        self.source = None  # 重建时的原文件
+        self.written = []  # 已写入、还没有返回给调用方的章节id
+
+        # 偏移索引：每行 "章节id\t写完后的文件偏移"，用于续传时截掉写了一半的章节。
+        # 进度日志只在检查点记录，之后写入的章节下次会重新下载，所以截到最后一个已记入进度（done）的章节
+        end_offset = None
+        header_end = None
+        entries = []  # 原文件中的章节：(章节id, 起始偏移, 结束偏移)
+        if os.path.exists(path) and os.path.exists(self.index_path):
+            kept = []
+            stale = False
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) != 2 or not parts[1].isdigit():
+                        continue
+                    if not parts[0].startswith('#') and parts[0] not in done:
+                        stale = True
+                        break
+                    if parts[0] == '#header':
+                        header_end = int(parts[1])
+                    elif parts[0].startswith('#'):
+                        # 旧版本生成的文件不知道各章节的位置，无法重建
+                        header_end = None
+                    else:
+                        entries.append((parts[0], end_offset, int(parts[1])))
+                    end_offset = int(parts[1])
+                    kept.append(line if line.endswith('\n') else line + '\n')
+            if stale:
+                with open(self.index_path + ".tmp", 'w', encoding='utf-8') as f:
+                    f.write(''.join(kept))
+                os.replace(self.index_path + ".tmp", self.index_path)
+
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(header.encode('utf-8'))
+            end_offset = len(header.encode('utf-8'))
+            with open(self.index_path, 'w', encoding='utf-8') as f:
+                f.write(f"#header\t{end_offset}\n")
+        elif end_offset is None:
+            # 旧版本生成的文件没有索引，从当前末尾继续追加
+            end_offset = os.path.getsize(path)
+            with open(self.index_path, 'w', encoding='utf-8') as f:
+                f.write(f"#legacy\t{end_offset}\n")
+
+        positions = {chap["id"]: chap["index"] for chap in chapters}
+        if header_end is not None and self.out_of_order(entries, positions):
+            self.rebuild(entries, positions, header_end, end_offset)
+            return
+        self.file = open(path, 'r+b')
+        self.file.truncate(end_offset)
+        self.file.seek(end_offset)
+        self.index_file = open(self.index_path, 'a', encoding='utf-8')
+
+    def out_of_order(self, entries, positions):
+        """追加本次的章节后是否不再按目录顺序"""
+        written = [positions[entry[0]] for entry in entries if entry[0] in positions]
+        if not written or not self.order:
+            return False
+        return written != sorted(written) or min(self.order) < written[-1]
+
+    def rebuild(self, entries, positions, header_end, end_offset):
+        """按目录顺序写入新文件：原文件中的章节排在目录中的位置，目录中已删除的章节跟在它前一章之后"""
+        items = []
+        position = -1
+        for sequence, entry in enumerate(entries):
+            if entry[0] in positions:
+                position = positions[entry[0]]
+                items.append(((position, 0, sequence), entry))
+            else:
+                items.append(((position, 1, sequence), entry))
+        items.extend(((index, 0, 0), index) for index in self.order)
+        self.order = [item for _, item in sorted(items, key=lambda pair: pair[0])]
+
+        # 原文件中续传时没截掉的残留不在索引中，不会被复制
+        self.source = open(self.path, 'rb')
+        self.file = open(self.path + ".rebuild", 'w+b')
+        self.file.write(self.source.read(header_end))
+        self.index_file = open(self.index_path + ".rebuild", 'w', encoding='utf-8')
+        self.index_file.write(f"#header\t{header_end}\n")
+        self.drain()
+
+    def add(self, index, chapter_id, title, rendered):
+        """加入一个已渲染的章节，返回本次按顺序落盘的章节id（重建时在完成替换后才返回）"""
+        data = rendered.encode('utf-8')
+        if self.cursor < len(self.order) and self.order[self.cursor] == index:
+            # 按顺序到达的章节直接写入，不经过重排缓冲区
+            self.write(chapter_id, data)
+        else:
+            self.pending.put(index, chapter_id, data)
+        self.drain()
+        return self.collect()
+
+    def skip(self, index):
+        """放弃一个章节，之后的章节不再等待它"""
+        self.pending.skip(index)
+        self.drain()
+        return self.collect()
+
+    def drain(self, final=False):
+        """按顺序写出能写的章节；final为True时跳过还没到达的章节"""
+        while self.cursor < len(self.order):
+            key = self.order[self.cursor]
+            if isinstance(key, tuple):
+                self.copy(*key)
+            elif key in self.pending:
+                entry = self.pending.pop(key)
+                if entry is None:
+                    self.cursor += 1
+                else:
+                    self.write(*entry)
+            elif final:
+                self.cursor += 1
+            else:
+                break
+
+    def collect(self):
+        if self.source is not None:
+            return []
+        written = self.written
+        self.written = []
+        return written
+
+    def write(self, chapter_id, data):
+        self.file.write(data)
+        self.index_file.write(f"{chapter_id}\t{self.file.tell()}\n")
+        self.written.append(chapter_id)
+        self.cursor += 1
+
+    def copy(self, chapter_id, start, end):
+        """重建时从原文件复制一个已写入的章节"""
+        self.source.seek(start)
+        self.file.write(self.source.read(end - start))
+        self.index_file.write(f"{chapter_id}\t{self.file.tell()}\n")
+        self.cursor += 1
+
+    def flush(self):
+        # 检查点：正文和索引在进度日志之前落盘，续传时只信任已记入进度的章节的偏移
+        self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        """完成写入，返回此前还没有返回的章节id（重建时为写入新文件的章节）"""
+        if self.file.closed:
+            return []
+        if self.source is not None:
+            # 没到达的章节留空，原文件中的章节全部复制后替换原文件
+            self.drain(final=True)
+        self.flush()
+        if self.source is not None:
+            # 新文件落盘后才替换原文件
+            os.fsync(self.file.fileno())
+            os.fsync(self.index_file.fileno())
+        self.file.close()
+        self.index_file.close()
+        self.pending.close()
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+            os.replace(self.path + ".rebuild", self.path)
+            os.replace(self.index_path + ".rebuild", self.index_path)
+        return self.collect()
+
+def get_volume_path(path, number):
+    """EPUB分卷后第number卷的文件路径"""
+    base, ext = os.path.splitext(path)
+    return f"{base}_第{number}卷{ext}"
+
+class EpubChapterWriter:
+    """EPUB增量写入：章节XHTML按章节id写入暂存目录（用于续传和更新），按目录顺序流式写入EPUB，超过阈值时分卷
+
+    每次完成时都用全部暂存章节重新生成EPUB，更新模式下目录中间插入的新章节也会排在正确的位置
+    """
+
+    def __init__(self, path, name, author_name, description, chapters):
+        self.path = path
+        self.name = name
+        self.author_name = author_name
+        self.description = description
+        self.stage_dir = path + ".parts"
+        os.makedirs(self.stage_dir, exist_ok=True)
+        manifest_path = os.path.join(self.stage_dir, "toc.tsv")
+
+        # 章节的排序位置：本次目录中的序号；目录中已删除的章节沿用暂存时的序号
+        self.positions = {chap["id"]: chap["index"] for chap in chapters}
+        self.ids = {chap["index"]: chap["id"] for chap in chapters}
+        # 之前运行已暂存的章节与本次待下载的章节一起按顺序写入
+        self.ready = {}  # 已暂存、等待写入EPUB的章节：章节id -> 标题
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t', 2)
+                    if len(parts) == 3 and parts[0].isdigit() and os.path.exists(self.part_path(parts[1])):
+                        self.ready[parts[1]] = parts[2]
+                        self.positions.setdefault(parts[1], int(parts[0]))
+        self.order = sorted(self.positions, key=self.sort_key)
+        self.cursor = 0
+        self.manifest = open(manifest_path, 'a', encoding='utf-8')
+        self.volume = None
+        self.volume_paths = []
+        self.output_paths = [path]  # 完成后的输出文件，分卷时为各卷的路径
+        self.advance()
+
+    def sort_key(self, chapter_id):
+        return self.positions[chapter_id], chapter_id
+
+    def part_path(self, chapter_id):
+        return os.path.join(self.stage_dir, f"chap_{chapter_id}.xhtml")
+
+    def add(self, index, chapter_id, title, rendered):
+        """暂存一个已渲染的章节，返回已落盘的章节id"""
+        part_path = self.part_path(chapter_id)
+        with open(part_path + ".tmp", 'wb') as f:
+            f.write(rendered)
+        os.replace(part_path + ".tmp", part_path)
+        safe_title = re.sub(r'[\t\r\n]+', ' ', title)
+        self.manifest.write(f"{index}\t{chapter_id}\t{safe_title}\n")
+        self.ready[chapter_id] = safe_title
+        self.advance()
+        return [chapter_id]
+
+    def skip(self, index):
+        """放弃一个章节，之后的章节不再等待它"""
+        chapter_id = self.ids.get(index)
+        if chapter_id in self.order[self.cursor:] and chapter_id not in self.ready:
+            self.order.remove(chapter_id)
+            self.advance()
+        return []
+
+    def advance(self):
+        """把已就绪的连续章节写入EPUB"""
+        while self.cursor < len(self.order) and self.order[self.cursor] in self.ready:
+            self.stream(self.order[self.cursor])
+            self.cursor += 1
+
+    def stream(self, chapter_id):
+        epub_config = CONFIG["epub"]
+        if self.volume is not None and (
+                (epub_config["volume_chapters"] and len(self.volume.chapters) >= epub_config["volume_chapters"]) or
+                (epub_config["volume_bytes"] and self.volume.bytes >= epub_config["volume_bytes"])):
+            self.finish_volume(split=True)
+        if self.volume is None:
+            self.volume_paths.append(f"{self.path}.{len(self.volume_paths) + 1}.tmp")
+            self.volume = StreamingEpubWriter(self.volume_paths[-1])
+        with open(self.part_path(chapter_id), 'rb') as f:
+            self.volume.add(self.ready.pop(chapter_id), f.read())
+
+    def finish_volume(self, split):
+        title = f"{self.name} 第{len(self.volume_paths)}卷" if split else self.name
+        self.volume.close(title, self.author_name, self.description)
+        self.volume = None
+
+    def flush(self):
+        self.manifest.flush()
+
+    def close(self):
+        if self.manifest.closed:
+            return
+        self.manifest.close()
+        # 中途失败而缺失的章节跳过，其余章节照常写入
+        for chapter_id in sorted(self.ready, key=self.sort_key):
+            self.stream(chapter_id)
+        if self.volume is None:
+            return
+        split = len(self.volume_paths) > 1
+        self.finish_volume(split)
+        if not split:
+            os.replace(self.volume_paths[0], self.path)
+            return
+        self.output_paths = []
+        for number, volume_path in enumerate(self.volume_paths, 1):
+            self.output_paths.append(get_volume_path(self.path, number))
+            os.replace(volume_path, self.output_paths[-1])
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class BookInfoParser(HTMLParser):
+    """只提取书名（第一个h1）、作者（第一个div.author-name 中的 span.author-name-text）、
+    简介（第一个div.page-abstract-content 中的第一个p），三项都确定后不再解析页面其余部分
+
+    按与BeautifulSoup相同的方式维护打开的标签栈（结束标签会关闭其后未闭合的标签），
+    只含空白的文字同样压缩为一个空格或换行，结果与原来用BeautifulSoup解析一致
+    """
+
+    FIELDS = ("name", "author", "description")
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+                 "source", "track", "wbr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.result = {}  # 已确定的字段，没找到的为None
+        self.stack = []  # 打开的标签：[标签, 作用, 字段, 文字]，作用为None、"capture"或"container"
+        self.text = []  # 两个标签之间的文字
+
+    @property
+    def done(self):
+        return len(self.result) == len(self.FIELDS)
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        if tag in self.VOID_TAGS:
+            return
+        role = field = None
+        classes = (dict(attrs).get("class") or "").split()
+        if tag == "h1" and self.is_open("name"):
+            role, field = "capture", "name"
+        elif tag == "div" and "author-name" in classes and self.is_open("author", "container"):
+            role, field = "container", "author"
+        elif tag == "div" and "page-abstract-content" in classes and self.is_open("description", "container"):
+            role, field = "container", "description"
+        elif tag == "span" and "author-name-text" in classes and self.in_container("author"):
+            role, field = "capture", "author"
+        elif tag == "p" and self.in_container("description"):
+            role, field = "capture", "description"
+        self.stack.append([tag, role, field, []])
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+        if not any(entry[0] == tag for entry in self.stack):
+            return
+        while True:
+            entry = self.stack.pop()
+            self.close_entry(entry)
+            if entry[0] == tag:
+                return
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_comment(self, data):
+        # 注释、声明等节点会把前后的文字分成两段
+        self.flush_text()
+
+    handle_decl = handle_pi = unknown_decl = handle_comment
+
+    def flush_text(self):
+        if not self.text:
+            return
+        data = "".join(self.text)
+        self.text = []
+        if not data.strip(" \t\n\r\f"):
+            data = "\n" if "\n" in data else " "
+        for entry in self.stack:
+            if entry[1] == "capture":
+                entry[3].append(data)
+
+    def close_entry(self, entry):
+        if entry[1] == "capture":
+            self.result.setdefault(entry[2], "".join(entry[3]))
+        elif entry[1] == "container":
+            # 只看第一个作者/简介区域，里面没有目标节点时视为没有
+            self.result.setdefault(entry[2], None)
+
+    def finish(self):
+        """页面结束时仍未闭合的节点按已收集的文字计"""
+        self.close()
+        self.flush_text()
+        while self.stack:
+            self.close_entry(self.stack.pop())
+
+    def is_open(self, field, role="capture"):
+        """该字段还未确定，也没有正在处理的同一字段的节点"""
+        return field not in self.result and not any(entry[2] == field for entry in self.stack)
+
+    def in_container(self, field):
+        if field in self.result:
+            return False
+        fields = [(entry[1], entry[2]) for entry in self.stack]
+        return ("container", field) in fields and ("capture", field) not in fields
+
+def parse_book_info(page, chunk_size=16384):
+    """从书籍页面提取 (书名, 作者, 简介)，找不到的项为None"""
+    parser = BookInfoParser()
+    for i in range(0, len(page), chunk_size):
+        parser.feed(page[i:i + chunk_size])
+        if parser.done:
+            break
+    else:
+        parser.finish()
+    return tuple(parser.result.get(field) for field in BookInfoParser.FIELDS)
+
+def parse_book_page(response):
+    """解析书籍页面，返回 [书名, 作者, 简介]，请求失败或页面中没有书名时返回None（不缓存）"""
+    if response.status_code != 200:
+        with print_lock:
+            print(f"网络请求失败，状态码: {response.status_code}")
+        return None
+
+    name, author_name, description = parse_book_info(response.text)
+    if name is None:
+        # 验证页、错误页等不是书籍页面，不能当作书籍信息缓存
+        with print_lock:
+            print("书籍页面中没有找到书名")
+        return None
+    if author_name is None:
+        author_name = "未知作者"
+    if description is None:
+        description = "无简介"
+    return [name, author_name, description]
 
 def get_book_info(book_id, headers):
     """获取书名、作者、简介"""
-    url = f'https://fanqienovel.com/page/{book_id}'
+    url = f'{CONFIG["site_base"]}/page/{book_id}'
     try:
-        response = requests.get(url, headers=headers, timeout=CONFIG["request_timeout"])
-        if response.status_code != 200:
-            with print_lock:
-                print(f"网络请求失败，状态码: {response.status_code}")
+        info = fetch_metadata(book_id, "info", url, headers, parse_book_page, CONFIG["metadata_cache"]["info_ttl"])
+        if info is None:
             return None, None, None
+        return tuple(info)
+    except Exception as e:
+        with print_lock:
+            print(f"获取书籍信息失败: {str(e)}")
+        return None, None, None
+
+class RetryScheduler:
+    """逐章节的重试调度：记录每章的尝试次数，失败的章节按下次可重试的时间进入优先队列，等待期间其他章节照常下载"""
+
+    def __init__(self, chapters, on_failed):
+        self.fresh = deque(chapters)
+        self.waiting = []  # (可重试的时间, 序号, 章节)
+        self.attempts = {}
+        self.sequence = 0
+        self.on_failed = on_failed
+        self.config = CONFIG["retry"]
+
+    def empty(self):
+        return not self.fresh and not self.waiting
+
+    def take(self, count):
+        """取出最多count个可以请求的章节：先取已到重试时间的，再按顺序取新章节"""
+        now = time.time()
+        batch = []
+        while self.waiting and self.waiting[0][0] <= now and len(batch) < count:
+            batch.append(heapq.heappop(self.waiting)[2])
+        while self.fresh and len(batch) < count:
+            batch.append(self.fresh.popleft())
+        return batch
+
+    def wait_time(self):
+        """距离最早一个等待重试的章节可以请求的秒数，没有等待的章节时返回None"""
+        if not self.waiting:
+            return None
+        return max(0.0, self.waiting[0][0] - time.time())
+
+    def fail(self, chap, min_delay=0):
+        """记录一次失败：未用完次数时按指数退避排队，否则放弃"""
+        attempts = self.attempts.get(chap["id"], 0) + 1
+        self.attempts[chap["id"]] = attempts
+        if self.config["max_attempts"] and attempts >= self.config["max_attempts"]:
+            self.on_failed(chap)
+            return
+        delay = min(self.config["max_delay"], self.config["base_delay"] * (2 ** (attempts - 1)))
+        delay = max(min_delay, random.uniform(delay / 2, delay))
+        self.sequence += 1
+        heapq.heappush(self.waiting, (time.time() + delay, self.sequence, chap))
 
-        soup = bs4.BeautifulSoup(response.text, 'html.parser')
+def download_with_threads(todo_chapters, headers, handle_chapter, on_batch_done, on_failed):
+    """线程引擎：按大批次并行请求批量接口，缺失的章节交给重试调度器，重试次数用完时调用on_failed"""
+    controller = get_controller()
+    scheduler = RetryScheduler(todo_chapters, on_failed)
+    retry_count = 0
+
+    while not scheduler.empty():
+        # 批量大小与并发数由控制器根据接口状态决定
+        chunk_size = controller.batch_size
+        workers = controller.concurrency
+        current_batch = scheduler.take(chunk_size * workers)
+        if not current_batch:
+            # 只剩等待重试的章节
+            time.sleep(scheduler.wait_time())
+            continue
         
-        name_element = soup.find('h1')
-        name = name_element.text if name_element else "未知书名"
+        item_ids = [chap["id"] for chap in current_batch]
+        chapters = {chap["id"]: chap for chap in current_batch}
+        handled = set()
+        handle_lock = threading.Lock()
+
+        def handle_entry(chapter_id, entry):
+            # 各线程解析出一章就交给流水线，不必等整批下载完
+            with handle_lock:
+                if handle_chapter(chapters[chapter_id], entry):
+                    handled.add(chapter_id)
+
+        # 多线程批量下载
+        def process_batch_chunk(chunk):
+            return batch_download_chapters_official(chunk, headers, handle_entry)
         
-        author_name = "未知作者"
-        author_name_element = soup.find('div', class_='author-name')
-        if author_name_element:
-            author_name_span = author_name_element.find('span', class_='author-name-text')
-            if author_name_span:
-                author_name = author_name_span.text
+        # 共用线程池，多本书同时下载时总并发由全局上限控制
+        executor = get_worker_pool()
+        chunk_futures = []
+        for j in range(0, len(item_ids), chunk_size):
+            chunk_ids = item_ids[j:j + chunk_size]
+            future = executor.submit(process_batch_chunk, chunk_ids)
+            chunk_futures.append((future, chunk_ids))
         
-        description = "无简介"
-        description_element = soup.find('div', class_='page-abstract-content')
-        if description_element:
-            description_p = description_element.find('p')
-            if description_p:
-                description = description_p.text
+        received = 0
+        for future, chunk_ids in chunk_futures:
+            try:
+                received += future.result()
+            except Exception as e:
+                with print_lock:
+                    print(f"批量下载块处理失败: {str(e)}")
+
+        # 没有成功交给流水线的章节交给调度器稍后重试
+        missing = [chap for chap in current_batch if chap["id"] not in handled]
+        if not received:
+            retry_count += 1
+            with print_lock:
+                print(f"批量下载失败，稍后重试... (重试次数: {retry_count})")
+        elif missing:
+            with print_lock:
+                print(f"本批次有 {len(missing)} 个章节下载失败，稍后重试...")
+        # 整批失败说明接口有问题，按控制器的退避时间推迟
+        min_delay = controller.retry_delay() if not received else 0
+        for chap in missing:
+            scheduler.fail(chap, min_delay)
+        on_batch_done()
         
-        return name, author_name, description
+        # 连续失败时先退避再发下一批，正常情况下的请求节奏由限速器控制
+        if not scheduler.empty():
+            time.sleep(controller.batch_pause())
+
+async def fetch_batch_once(session, batch_ids, headers, on_chapter, slot_held=False):
+    """异步请求一批章节，解析出一章就调用on_chapter，返回收到的章节数，失败时返回0；
+    slot_held为True时结束后释放对冲占用的在途名额"""
+    import asyncio
+    import aiohttp
+    backends = get_api_backends()
+    backend = backends.acquire()
+    endpoint = backend["endpoint"]
+    controller = get_controller()
+    params = {'item_ids': ','.join(batch_ids)}
+    timeout = aiohttp.ClientTimeout(total=CONFIG["official_api"]["timeout"])
+    wanted = set(batch_ids)
+    seen = set()
+    received = 0
+
+    def hand_off(pairs):
+        nonlocal received
+        for chapter_id, entry in pairs:
+            if chapter_id not in wanted:
+                continue
+            seen.add(chapter_id)
+            if isinstance(entry, dict) and entry.get("content"):
+                received += 1
+            on_chapter(chapter_id, entry)
+
+    async def deliver(pairs):
+        # 流水线队列满时on_chapter会阻塞，在线程中交接以免卡住事件循环上的其他请求
+        pairs = list(pairs)
+        if pairs:
+            await asyncio.to_thread(hand_off, pairs)
+
+    started = time.time()
+    released = False
+    try:
+        async with session.get(endpoint, params=params, headers=headers, timeout=timeout) as response:
+            backends.release(backend)
+            released = True
+            if response.status != 200:
+                controller.record(time.time() - started, len(batch_ids), 0, False)
+                print_once(f"官方API批量下载失败，状态码: {response.status}", "batch_status")
+                report_api_log(endpoint)
+                return 0
+            if CONFIG["official_api"]["stream"]:
+                parser = ChapterStreamParser()
+                async for chunk in response.content.iter_chunked(CONFIG["official_api"]["stream_chunk_size"]):
+                    await deliver(parser.feed(chunk))
+                await deliver(parser.close())
+            else:
+                data = load_json(await response.read())
+                if isinstance(data, dict):
+                    await deliver(data.items())
+    except asyncio.CancelledError:
+        # 对冲中落后的请求被取消，不算实例的错误
+        if not released:
+            backends.release(backend)
+        raise
     except Exception as e:
-        with print_lock:
-            print(f"获取书籍信息失败: {str(e)}")
-        return None, None, None
+        if not released:
+            # 超时或连接失败的实例会被暂时摘除
+            backends.release(backend, healthy=False)
+        controller.record(time.time() - started, len(batch_ids), received, False)
+        print_once(f"官方API批量请求异常（{endpoint}）: {str(e) or type(e).__name__}", "batch_exception")
+        report_api_log(endpoint)
+        return 0
+    finally:
+        if slot_held:
+            get_batch_slots().release()
+    for chapter_id in batch_ids:
+        if chapter_id not in seen:
+            print_once(f"章节 {chapter_id} 不在批量下载中！", "chapter_missing")
+    controller.record(time.time() - started, len(batch_ids), received, True)
+    get_hedge_policy().observe(time.time() - started)
+    return len(seen)
 
-def load_status(save_path):
-    """加载下载状态"""
-    status_file = os.path.join(save_path, CONFIG["status_file"])
-    if os.path.exists(status_file):
+async def fetch_batch_async(session, batch_ids, headers, on_chapter):
+    """异步请求一批章节，返回收到的章节数；启用对冲时超过等待时间再发一个相同的请求，
+    先完整返回的请求胜出并取消另一个，两个请求收到的同一章节由on_chapter去重；
+    限速由调用方在占用名额前处理，对冲请求不再经过限速器"""
+    import asyncio
+    hedge = get_hedge_policy()
+    delay = hedge.delay()
+    with metrics.timed("batch_request"):
+        primary = asyncio.ensure_future(fetch_batch_once(session, batch_ids, headers, on_chapter))
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not hedge.try_hedge():
+            return await primary
+        secondary = asyncio.ensure_future(fetch_batch_once(session, batch_ids, headers, on_chapter, slot_held=True))
+        pending = {primary, secondary}
+        delivered = 0
+        while pending and not delivered:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result() and not delivered:
+                    delivered = task.result()
+                    if task is secondary:
+                        metrics.count("hedge_won")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return delivered
+
+async def download_async(todo_chapters, headers, handle_chapter, on_batch_done, on_failed):
+    """异步引擎：限制在途批量请求数，结果到达即处理，缺失的章节交给重试调度器"""
+    import asyncio
+    import aiohttp
+    controller = get_controller()
+    scheduler = RetryScheduler(todo_chapters, on_failed)
+    connector = aiohttp.TCPConnector(limit=max(CONFIG["max_workers"], CONFIG["adaptive"]["max_workers"]), ssl=False)
+
+    async def run_batch(session, batch):
+        chapters = {chap["id"]: chap for chap in batch}
+        handled = set()
+        handle_lock = threading.Lock()
+
+        def handle_entry(chapter_id, entry):
+            # 解析出一章就交给流水线（在线程中调用）；对冲的两个请求可能返回同一章节，只处理先到的
+            with handle_lock:
+                if chapter_id not in handled and handle_chapter(chapters[chapter_id], entry):
+                    handled.add(chapter_id)
+
+        # 先等限速再占用名额，限速等待不计入批量请求的耗时
+        await wait_for_rate_limit_async(len(chapters))
+        # 全局上限是线程信号量，在线程中等待以免阻塞事件循环
+        slots = get_batch_slots()
+        await asyncio.to_thread(slots.acquire)
         try:
-            with open(status_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            delivered = await fetch_batch_async(session, list(chapters), headers, handle_entry)
+        finally:
+            slots.release()
+        return batch, handled, delivered
+
+    in_flight = set()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while not scheduler.empty() or in_flight:
+            # 在途请求数与批量大小随控制器实时调整
+            while len(in_flight) < controller.concurrency:
+                batch = scheduler.take(controller.batch_size)
+                if not batch:
+                    break
+                in_flight.add(asyncio.ensure_future(run_batch(session, batch)))
+
+            if not in_flight:
+                # 只剩等待重试的章节
+                await asyncio.sleep(scheduler.wait_time())
+                continue
+            # 有章节等待重试时到点醒来补发
+            done, in_flight = await asyncio.wait(in_flight, timeout=scheduler.wait_time(),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch, handled, delivered = task.result()
+                missing = [chap for chap in batch if chap["id"] not in handled]
+                on_batch_done()
+                if missing:
+                    with print_lock:
+                        print(f"有 {len(missing)} 个章节下载失败，稍后重试...")
+                    # 缺失章节退避后重试，不阻塞其他批次；整批失败时按控制器的退避时间推迟
+                    min_delay = controller.retry_delay() if not delivered else 0
+                    for chap in missing:
+                        scheduler.fail(chap, min_delay)
+
+def download_with_asyncio(todo_chapters, headers, handle_chapter, on_batch_done, on_failed):
+    """以asyncio引擎下载，缺少aiohttp时退回线程引擎"""
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        print_once("未安装aiohttp，已退回线程引擎", "engine_fallback")
+        return download_with_threads(todo_chapters, headers, handle_chapter, on_batch_done, on_failed)
+    import asyncio
+    asyncio.run(download_async(todo_chapters, headers, handle_chapter, on_batch_done, on_failed))
+
+class StatusJournal:
+    """断点续传日志：每完成一章追加一行章节id，批量刷盘，定期压缩后原子替换
+
+    记录的是已写入某个格式输出文件的章节，不同格式各有一个日志
+    """
+
+    def __init__(self, save_path, book_id, file_format='txt', chapter_ids=()):
+        self.path = os.path.join(save_path, CONFIG["status_file"].format(book_id=book_id, format=file_format))
+        self.done = set()
+        self.pending = []
+        self.file = None
+        self.lines = 0
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self.load()
+        elif file_format == 'txt':
+            # 旧版本所有书共用一个chapter.json（记录的是TXT的进度），只导入本书目录（chapter_ids）中的章节，
+            # 导入后由本书的日志接管
+            legacy_file = os.path.join(save_path, CONFIG["legacy_status_file"])
+            try:
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
                 if isinstance(data, list):
-                    return set(data)
-                return set()
-        except:
-            pass
-    return set()
+                    self.done = set(data).intersection(chapter_ids)
+            except (OSError, ValueError, TypeError):
+                pass
+            if self.done:
+                # 导入的记录立即写入本书的日志，否则之后只会追加新完成的章节
+                self.compact()
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # 最后一行没有换行说明写入被中断，丢弃这半条记录
+        complete = data[:data.rfind(b'\n') + 1]
+        for line in complete.decode('utf-8', errors='ignore').splitlines():
+            line = line.strip()
+            if line:
+                self.done.add(line)
+                self.lines += 1
+        if len(complete) != len(data) or self.lines > len(self.done):
+            self.compact()
+
+    def add(self, chapter_ids):
+        """记录已写入输出文件的章节"""
+        with self.lock:
+            new_ids = [chapter_id for chapter_id in chapter_ids if chapter_id not in self.done]
+            if not new_ids:
+                return
+            # 先放在内存中，等输出文件落盘后随flush一起写入日志
+            self.pending.extend(new_ids)
+            self.done.update(new_ids)
+
+    def flush(self, force=False):
+        """写入新记录，累计足够多的记录后fsync"""
+        with self.lock:
+            if self.pending:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write(''.join(f"{chapter_id}\n" for chapter_id in self.pending))
+                self.lines += len(self.pending)
+                self.unsynced += len(self.pending)
+                self.pending = []
+            if self.file is None:
+                return
+            self.file.flush()
+            if force or self.unsynced >= CONFIG["journal"]["fsync_every"]:
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+            if self.lines > len(self.done) * CONFIG["journal"]["compact_ratio"] + 100:
+                self.compact()
+
+    def compact(self):
+        """重写为去重后的日志，写临时文件后原子替换"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(f"{chapter_id}\n" for chapter_id in self.done))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.lines = len(self.done)
 
-def save_status(save_path, downloaded):
+    def reset(self):
+        """清空进度，输出文件已不存在时从头生成"""
+        with self.lock:
+            self.done = set()
+            self.pending = []
+            self.compact()
+
+    def close(self):
+        self.flush(force=True)
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def load_status(save_path, book_id, file_format='txt', chapter_ids=()):
+    """加载下载状态，chapter_ids为本书目录中的章节id（用于导入旧版本的进度）"""
+    return StatusJournal(save_path, book_id, file_format, chapter_ids)
+
+def save_status(journal):
     """保存下载状态"""
-    status_file = os.path.join(save_path, CONFIG["status_file"])
-    with open(status_file, 'w', encoding='utf-8') as f:
-        json.dump(list(downloaded), f, ensure_ascii=False, indent=2)
+    with metrics.timed("save_status"):
+        journal.flush()
+
+def get_book_state_path(save_path, book_id):
+    return os.path.join(save_path, CONFIG["book_state_file"].format(book_id=book_id))
+
+def load_book_state(save_path, book_id):
+    """读取上次同步时保存的目录与书籍信息，没有时返回None"""
+    try:
+        with open(get_book_state_path(save_path, book_id), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get("item_ids"), list):
+        return None
+    return state
+
+def save_book_state(save_path, book_id, chapters, name, author_name, description, file_format):
+    """保存本次同步的目录与书籍信息，写临时文件后原子替换"""
+    path = get_book_state_path(save_path, book_id)
+    state = {
+        "item_ids": [chap["id"] for chap in chapters],
+        "name": name,
+        "author": author_name,
+        "description": description,
+        "format": file_format,
+        "updated": int(time.time())
+    }
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def find_tracked_books(save_path):
+    """列出保存路径下所有保存了同步信息的书籍id"""
+    prefix, suffix = CONFIG["book_state_file"].split("{book_id}")
+    try:
+        names = os.listdir(save_path)
+    except OSError:
+        return []
+    return sorted(name[len(prefix):len(name) - len(suffix)] for name in names
+                  if name.startswith(prefix) and name.endswith(suffix) and len(name) > len(prefix) + len(suffix))
 
 def get_chapter_range_selection(chapters):
     """获取章节范围"""
@@ -391,201 +2777,216 @@ def get_chapter_range_selection(chapters):
         except KeyboardInterrupt:
             return None, None
 
-def Run(book_id, save_path, file_format='txt', start_chapter=None, end_chapter=None):
-    """运行下载"""
+def Run(book_id, save_path, file_format='txt', start_chapter=None, end_chapter=None, chapters=None, resume=None,
+        update=False):
+    """运行下载，chapters为已获取的章节目录时不再重复请求；resume为None时询问是否继续上次的下载
+    
+    update为True时（更新模式）使用上次保存的书籍信息和格式，只下载目录中新增（及之前失败）的章节并追加到输出文件
+    
+    成功时返回输出文件路径（EPUB分卷时为第一卷）；有章节多次重试仍失败时返回None，已下载的章节仍保存在输出文件中
+    """
+    writer = None
+    pipeline = None
+    journal = None
+    run_metrics = metrics.start_scope()
+
     def signal_handler(sig, frame):
         print("\n检测到程序中断，正在保存已下载内容...")
-        write_downloaded_chapters_in_order()
-        save_status(save_path, downloaded)
+        close_writer()
         print(f"已保存下载的章节进度")
         stop_web_service()
         sys.exit(0)
     
-    # 信号处理函数
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    # 信号处理函数（只能在主线程注册，多书并发下载时由进度日志保证可续传）
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+
+    def save_progress():
+        """已提交的章节写入后保存进度"""
+        if pipeline is not None:
+            pipeline.checkpoint()
 
-    def write_downloaded_chapters_in_order():
-        """按章节顺序写入"""
-        if not chapter_results:
+    def close_writer():
+        """处理完流水线中的章节，保存进度并完成输出文件"""
+        if writer is None:
             return
-        
-        if file_format == 'txt':
-            with open(output_file_path, 'w', encoding='utf-8') as f:
-                f.write(f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n")
-                # 按章节索引顺序写入
-                for idx in sorted(chapter_results.keys()):
-                    result = chapter_results[idx]
-                    title = result["api_title"] if result["api_title"] else result["base_title"]
-                    f.write(f"{title}\n{result['content']}\n\n")
-        elif file_format == 'epub':
-            book = create_epub_book(name, author_name, description, chapter_results, chapters)
-            epub.write_epub(output_file_path, book, {})
+        if pipeline is not None:
+            pipeline.close()
+        writer.flush()
+        # TXT重建时新章节在替换原文件后才算写入
+        written = writer.close()
+        if written:
+            journal.add(written)
+        journal.close()
 
     try:
         headers = get_headers()
-        chapters = get_chapters_from_api(book_id, headers)
+        state = load_book_state(save_path, book_id) if update else None
+        info_executor = None
+        if not (state and state.get("name")):
+            # 书籍页面与目录同时请求
+            info_executor = ThreadPoolExecutor(max_workers=1)
+            info_future = info_executor.submit(get_book_info, book_id, headers)
+            info_executor.shutdown(wait=False)
+        if not chapters:
+            # 更新模式需要最新的目录，缓存只在服务器确认未修改时使用
+            chapters = get_chapters_from_api(book_id, headers, revalidate=update)
         if not chapters:
             print("未找到任何章节，请检查小说ID是否正确。")
             return
         
+        # 导入旧版本进度时按完整目录筛选本书的章节
+        directory_ids = [chap["id"] for chap in chapters]
+
         # 指定了章节范围时
         if start_chapter is not None and end_chapter is not None:
             filtered_chapters = chapters[start_chapter:end_chapter+1]
             print(f"已选择章节范围: 第{start_chapter+1}章 - 第{end_chapter+1}章 (共{len(filtered_chapters)}章)")
             chapters = filtered_chapters
 
-        name, author_name, description = get_book_info(book_id, headers)
+        if info_executor is None:
+            # 更新模式沿用上次的书名（即输出文件名）和格式，不再请求书籍页面
+            name, author_name, description = state["name"], state.get("author"), state.get("description")
+            file_format = state.get("format") or file_format
+        else:
+            name, author_name, description = info_future.result()
         if not name:
             name = f"未知小说_{book_id}"
             author_name = "未知作者"
             description = "无简介"
 
-        downloaded = load_status(save_path)
-        if downloaded and (start_chapter is None and end_chapter is None):
+        output_file_path = os.path.join(save_path, f"{name}.{file_format}")
+        journal = load_status(save_path, book_id, file_format, directory_ids)
+        # TXT按进度续写输出文件，EPUB由暂存目录中的章节生成；它们不存在时进度已无意义
+        writer_state = output_file_path if file_format == 'txt' else output_file_path + ".parts"
+        if journal.done and not os.path.exists(writer_state):
+            print(f"未找到《{name}》之前的输出文件，将重新生成（本地缓存中的章节不会重新下载）")
+            journal.reset()
+        downloaded = journal.done
+        if state:
+            known_ids = set(state["item_ids"])
+            current_ids = [chap["id"] for chap in chapters]
+            new_count = sum(1 for chapter_id in current_ids if chapter_id not in known_ids)
+            print(f"《{name}》目录共 {len(chapters)} 章，新增 {new_count} 章")
+            kept_ids = [chapter_id for chapter_id in current_ids if chapter_id in known_ids]
+            if len(kept_ids) != len(known_ids) or kept_ids != current_ids[:len(kept_ids)]:
+                # 新章节会按目录顺序写入，目录中已删除的章节仍保留在原来的位置
+                print(f"提示：《{name}》的目录有删改或新章节插在中间，将按新的目录顺序重新生成")
+        if update:
+            resume = True
+        elif downloaded and (start_chapter is None and end_chapter is None):
             print(f"检测到您曾经下载过小说《{name}》。")
-            if input("是否需要继续下载？(y/n)：") != "y":
+            if resume is None:
+                resume = input("是否需要继续下载？(y/n)：") == "y"
+            if not resume:
                 print("已取消下载")
                 return
 
         todo_chapters = [ch for ch in chapters if ch["id"] not in downloaded]
+        full_directory = start_chapter is None and end_chapter is None
         if not todo_chapters:
-            print("所有章节已是最新，无需下载")
-            return
+            # 上次已分卷输出时返回第一卷
+            for path in (output_file_path, get_volume_path(output_file_path, 1)):
+                if os.path.exists(path):
+                    print("所有章节已是最新，无需下载")
+                    if full_directory:
+                        save_book_state(save_path, book_id, chapters, name, author_name, description, file_format)
+                    return path
+            # EPUB文件被删除但章节都已暂存，下面直接用暂存的章节重新生成
+            print(f"所有章节都已下载，正在重新生成《{name}》")
 
         print(f"开始下载：《{name}》, 总章节数: {len(chapters)}, 待下载: {len(todo_chapters)}")
+        start_metrics_server()
         os.makedirs(save_path, exist_ok=True)
         
-        output_file_path = os.path.join(save_path, f"{name}.{file_format}")
-        if file_format == 'txt' and not os.path.exists(output_file_path):
-            with open(output_file_path, 'w', encoding='utf-8') as f:
-                f.write(f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n")
+        if file_format == 'txt':
+            header = f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n"
+            writer = TxtChapterWriter(output_file_path, header, chapters, todo_chapters, journal.done)
+        else:
+            writer = EpubChapterWriter(output_file_path, name, author_name, description, chapters)
+        # 只有按顺序写入输出文件后才记入进度
+        pipeline = ChapterPipeline(writer, file_format, journal.add, lambda: save_status(journal))
 
-        success_count = 0
         failed_chapters = []
-        chapter_results = {}
-        lock = threading.Lock()
-        print_lock = threading.Lock()
-        all_futures = []
+
+        def handle_failed(chap):
+            """重试次数用完的章节：记下来并让输出文件跳过它"""
+            failed_chapters.append(chap)
+            pipeline.skip(chap)
+
+        def handle_chapter(chap, entry):
+            """把下载到的章节交给流水线，正文为空时返回False以便重试"""
+            if not entry or not isinstance(entry, dict):
+                return False
+            content = entry.get("content", "")
+            title = entry.get("title", "")
+            if not content:
+                return False
+            pipeline.submit(chap, title or chap["title"], content)
+            pbar.update(1)
+            return True
+
+        # 先从本地缓存取章节，只下载缓存中没有的
+        cache = get_chapter_cache()
+        if cache is not None:
+            cached_ids = set()
+            for i in range(0, len(todo_chapters), 200):
+                chunk = todo_chapters[i:i + 200]
+                cached = cache.get_many([chap["id"] for chap in chunk])
+                for chap in chunk:
+                    entry = cached.get(chap["id"])
+                    if entry:
+                        pipeline.submit(chap, entry["title"] or chap["title"], entry["content"], entry["cleaned"])
+                        cached_ids.add(chap["id"])
+            if cached_ids:
+                print(f"从本地缓存读取 {len(cached_ids)} 个章节")
+                save_progress()
+                todo_chapters = [chap for chap in todo_chapters if chap["id"] not in cached_ids]
 
         # 官方api批量下载
         if CONFIG["official_api"]["enabled"]:
-            print("正在使用官方API批量下载！")
-            batch_size = CONFIG["official_api"]["max_batch_size"]
-            
-            # 调整批量大小 - 基于线程数
-            dynamic_batch_size = batch_size * CONFIG["max_workers"]
-
-            with tqdm(total=len(todo_chapters), desc="批量下载进度") as pbar:
-                while todo_chapters:
-                    current_batch = todo_chapters[:dynamic_batch_size]
-                    todo_chapters = todo_chapters[dynamic_batch_size:]
-                    
-                    item_ids = [chap["id"] for chap in current_batch]
-                    retry_count = 0
-                    
-                    # 无限重试直到成功
-                    while current_batch:
-                        batch_results = {}
-                        
-                        # 多线程批量下载
-                        def process_batch_chunk(chunk):
-                            return batch_download_chapters_official(chunk, headers)
-                        
-                        # 大批分成小批并行处理
-                        chunk_size = max(1, dynamic_batch_size // CONFIG["max_workers"])
-                        
-                        with ThreadPoolExecutor(max_workers=CONFIG["max_workers"]) as executor:
-                            chunk_futures = []
-                            for j in range(0, len(item_ids), chunk_size):
-                                chunk_ids = item_ids[j:j + chunk_size]
-                                future = executor.submit(process_batch_chunk, chunk_ids)
-                                chunk_futures.append((future, chunk_ids))
-                                all_futures.append(future)
-                            
-                            for future, chunk_ids in chunk_futures:
-                                try:
-                                    chunk_result = future.result(timeout=CONFIG["official_api"]["timeout"])
-                                    if chunk_result:
-                                        batch_results.update(chunk_result)
-                                except Exception as e:
-                                    with print_lock:
-                                        print(f"批量下载块处理失败: {str(e)}")
-
-                        if not batch_results:
-                            with print_lock:
-                                print(f"批量下载失败，正在重试... (重试次数: {retry_count + 1})")
-                            retry_count += 1
-                            time.sleep(2)
-                            continue
-                        
-                        # 处理成功下载的章节
-                        new_current_batch = []
-                        new_item_ids = []
-                        for chap in current_batch:
-                            entry = batch_results.get(chap["id"])
-                            if entry and isinstance(entry, dict):
-                                content = entry.get("content", "")
-                                title = entry.get("title", "")
-                                if content:
-                                    processed_content = process_chapter_content(content)
-                                    processed = re.sub(r'^(\s*)', r'　　', processed_content, flags=re.MULTILINE)
-                                    with lock:
-                                        chapter_results[chap["index"]] = {
-                                            "base_title": chap["title"],
-                                            "api_title": title,
-                                            "content": processed
-                                        }
-                                        downloaded.add(chap["id"])
-                                        success_count += 1
-                                    pbar.update(1)
-                                else:
-                                    new_current_batch.append(chap)
-                                    new_item_ids.append(chap["id"])
-                            else:
-                                new_current_batch.append(chap)
-                                new_item_ids.append(chap["id"])
-                        
-                        # 如果还有失败的章节，继续重试
-                        current_batch = new_current_batch
-                        item_ids = new_item_ids
-                        
-                        if current_batch:
-                            with print_lock:
-                                print(f"本批次有 {len(current_batch)} 个章节下载失败，正在重试...")
-                            retry_count += 1
-                            time.sleep(1.5)
-                        else:
-                            # 本批次全部成功，保存进度
-                            write_downloaded_chapters_in_order()
-                            save_status(save_path, downloaded)
-                            break
-                    
-                    # 每批处理完成后给时间缓冲
-                    if todo_chapters:
-                        try:
-                            time.sleep(CONFIG["official_api"].get("batch_wait", 1.2))
-                        except Exception:
-                            pass
+            engine = download_with_asyncio if CONFIG["engine"] == "async" else download_with_threads
+
+            if todo_chapters:
+                print("正在使用官方API批量下载！")
+                from tqdm import tqdm
+                with tqdm(total=len(todo_chapters), desc="批量下载进度") as pbar:
+                    engine(todo_chapters, headers, handle_chapter, save_progress, handle_failed)
 
+            close_writer()
+            if len(writer.output_paths) > 1:
+                print(f"《{name}》已分为 {len(writer.output_paths)} 卷：" +
+                      "、".join(os.path.basename(path) for path in writer.output_paths))
+            if full_directory:
+                save_book_state(save_path, book_id, chapters, name, author_name, description, file_format)
+            print(f"自适应参数: {get_controller().summary()}")
+            stats = get_connection_stats()
+            print(f"HTTP请求 {stats['requests']} 次，复用连接 {stats['reused']} 次，新建连接 {stats['new_connections']} 次")
+            save_metrics_summary(book_id, run_metrics)
+            if failed_chapters:
+                failed_chapters.sort(key=lambda chap: chap["index"])
+                titles = "、".join(chap["title"] for chap in failed_chapters[:20])
+                more = f" 等 {len(failed_chapters)} 章" if len(failed_chapters) > 20 else ""
+                print(f"《{name}》有 {len(failed_chapters)} 个章节多次重试仍下载失败，已跳过：{titles}{more}")
+                print(f"已下载的章节保存在 {writer.output_paths[0]}，再次运行（或使用更新模式）会重新下载这些章节并按目录顺序补全")
+                return None
+            # 分卷时返回第一卷；一章都没有写入时不会生成EPUB
+            if not os.path.exists(writer.output_paths[0]):
+                print(f"《{name}》没有可以写入的章节，未生成输出文件")
+                return None
             print(f"下载完成！成功下载《{name}》", flush=True)
-            return
+            return writer.output_paths[0]
 
     except Exception as e:
         print(f"运行错误: {str(e)}")
-        if 'downloaded' in locals():
-            try:
-                write_downloaded_chapters_in_order()
-            except Exception:
-                pass
-            try:
-                save_status(save_path, downloaded)
-            except Exception:
-                pass
-        stop_web_service()
+        try:
+            close_writer()
+        except Exception:
+            pass
     finally:
-        # 由 atexit 在进程退出时统一清理
-        pass
+        # 官方API服务由 atexit 在进程退出时统一清理
+        metrics.end_scope(run_metrics)
 
 def get_chapter_range_selection(chapters):
     """获取章节范围"""
@@ -614,9 +3015,140 @@ def get_chapter_range_selection(chapters):
         except KeyboardInterrupt:
             return None, None
 
+def enable_official_api():
+    """启动并启用官方API，已启用时直接返回"""
+    with api_start_lock:
+        if CONFIG["official_api"]["enabled"]:
+            return True
+        print("正在启用官方API...")
+        if start_official_api():
+            CONFIG["official_api"]["enabled"] = True
+            print("官方API已启用")
+            return True
+        # 只换客户端连接的地址，api.py仍只监听本机
+        CONFIG["official_api"]["connect_host"] = "0.0.0.0"
+        reset_session()
+        print_once(f"启用官方API失败，已切换 http://0.0.0.0:{CONFIG['official_api']['port']}/content，正在重试...", "api_start")
+        if start_official_api():
+            CONFIG["official_api"]["enabled"] = True
+            print("官方API已启用")
+            return True
+        print("官方API启用失败，请检查 api.py 或环境后重试")
+        return False
+
+def download_book(book_id, save_path=None, file_format='txt', start_chapter=None, end_chapter=None, resume=True,
+                  update=False):
+    """下载一本书（不进行交互），成功时返回输出文件路径（EPUB分卷时为第一卷）
+
+    start_chapter/end_chapter 为从0开始的章节序号（含两端）；update为True时只追加新章节
+    """
+    if not enable_official_api():
+        return None
+    return Run(str(book_id), save_path or os.getcwd(), file_format, start_chapter, end_chapter, resume=resume,
+               update=update)
+
+def download_books(book_ids, save_path=None, file_format='txt', start_chapter=None, end_chapter=None,
+                   resume=True, max_books=None, update=False):
+    """批量下载多本书，共用官方API服务和批量请求线程池，返回 {书籍id: 输出文件路径}"""
+    if not enable_official_api():
+        return {}
+    max_books = max_books or CONFIG["scheduler"]["max_books"]
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_books) as executor:
+        futures = {executor.submit(download_book, book_id, save_path, file_format, start_chapter, end_chapter, resume,
+                                   update): book_id
+                   for book_id in book_ids}
+        for future in as_completed(futures):
+            book_id = futures[future]
+            try:
+                results[book_id] = future.result()
+            except Exception as e:
+                print(f"下载小说 {book_id} 失败: {str(e)}")
+                results[book_id] = None
+    return results
+
+def parse_chapter_range(value):
+    """解析 "起始-末尾" 形式的章节范围（从1开始），返回从0开始的序号"""
+    try:
+        start, end = (int(part) for part in value.split('-', 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError("章节范围格式应为 起始-末尾，例如 1-100")
+    if start < 1 or start > end:
+        raise argparse.ArgumentTypeError("起始章节需从1开始且不大于末尾章节")
+    return start - 1, end - 1
+
+def cli(argv=None):
+    """命令行模式，不进行交互，适合定时任务或任务队列"""
+    parser = argparse.ArgumentParser(description="番茄小说下载器精简版")
+    parser.add_argument("--book-id", nargs="+", default=[], help="小说ID，可填写多个")
+    parser.add_argument("--book-file", help="小说ID列表文件，每行一个")
+    parser.add_argument("--format", choices=["txt", "epub"], default="txt", help="下载格式")
+    parser.add_argument("--range", type=parse_chapter_range, help="章节范围，例如 1-100")
+    parser.add_argument("--out", default=os.getcwd(), help="保存路径")
+    parser.add_argument("--yes", action="store_true", help="检测到下载进度时自动继续，不再询问")
+    parser.add_argument("--update", action="store_true",
+                        help="更新模式：只下载上次同步后新增的章节并追加到原文件；未指定小说ID时更新保存路径下所有已下载的书")
+    parser.add_argument("--jobs", type=int, default=CONFIG["scheduler"]["max_books"], help="同时下载的书籍数")
+    parser.add_argument("--engine", choices=["thread", "async"], default=CONFIG["engine"], help="下载引擎")
+    parser.add_argument("--api-host", default=CONFIG["official_api"]["host"], help="官方API服务监听地址")
+    parser.add_argument("--api-port", type=int, default=CONFIG["official_api"]["port"], help="官方API服务端口")
+    parser.add_argument("--api-instances", type=int, default=CONFIG["official_api"]["instances"],
+                        help="官方API服务实例数，从--api-port开始使用连续端口，批量请求在实例间负载均衡")
+    parser.add_argument("--daemon", action="store_true", help="常驻模式：下载结束后保留官方API服务供下次复用")
+    parser.add_argument("--requests-per-second", type=float, default=CONFIG["rate_limit"]["requests_per_second"],
+                        help="限速：每秒最多发出的请求数，同一台机器上的多个下载进程共用，0表示不限")
+    parser.add_argument("--chapters-per-second", type=float, default=CONFIG["rate_limit"]["chapters_per_second"],
+                        help="限速：每秒最多请求的章节数，0表示不限")
+    parser.add_argument("--hedge", action="store_true", help="批量请求迟迟不返回时再发一个相同的请求，降低长尾延迟")
+    parser.add_argument("--metrics", help="下载结束后把各阶段耗时与错误计数写入该JSON文件，可包含{book_id}")
+    parser.add_argument("--metrics-port", type=int, help="下载期间在该端口提供Prometheus格式的指标")
+    parser.add_argument("--stop-api", action="store_true", help="停止常驻的官方API服务后退出")
+    args = parser.parse_args(argv)
+
+    CONFIG["official_api"]["host"] = args.api_host
+    CONFIG["official_api"]["port"] = args.api_port
+    CONFIG["official_api"]["instances"] = max(1, args.api_instances)
+    CONFIG["official_api"]["daemon"] = args.daemon
+    if args.stop_api:
+        return 0 if stop_daemon_api(args.api_port) else 1
+
+    book_ids = list(args.book_id)
+    if args.book_file:
+        with open(args.book_file, 'r', encoding='utf-8') as f:
+            book_ids.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if not book_ids and args.update:
+        book_ids = find_tracked_books(args.out)
+        if not book_ids:
+            print("保存路径下没有可以更新的小说")
+            return 0
+    if not book_ids:
+        parser.error("请通过 --book-id 或 --book-file 指定小说ID")
+    if args.update and args.range:
+        parser.error("更新模式不能指定章节范围")
+
+    CONFIG["engine"] = args.engine
+    CONFIG["hedge"]["enabled"] = args.hedge
+    CONFIG["rate_limit"]["requests_per_second"] = args.requests_per_second
+    CONFIG["rate_limit"]["chapters_per_second"] = args.chapters_per_second
+    CONFIG["metrics"]["summary_file"] = args.metrics
+    CONFIG["metrics"]["prometheus_port"] = args.metrics_port
+    start_chapter, end_chapter = args.range if args.range else (None, None)
+    # 未指定--yes时需要逐本询问，只能一本一本下载（更新模式不会询问）
+    resume = True if args.yes else None
+    max_books = args.jobs if args.yes or args.update else 1
+
+    try:
+        results = download_books(book_ids, args.out, args.format, start_chapter, end_chapter, resume, max_books,
+                                 args.update)
+    finally:
+        stop_web_service()
+    failed = [book_id for book_id in book_ids if not results.get(book_id)]
+    if failed:
+        print(f"以下小说未能完成下载: {', '.join(failed)}")
+        return 1
+    return 0
+
 def main():
-    global official_api_process
-    
     try:
         print("""欢迎使用番茄小说下载器精简版！
   开发者：Dlmily
@@ -624,27 +3156,15 @@ def main():
   Github：https://github.com/Dlmily/Tomato-Novel-Downloader-Lite
   赞助/了解新产品：https://afdian.com/a/dlbaokanluntanos
   *使用前须知*：
-  开始下载之后，您可能会过于着急而查看下载文件的位置，这是徒劳的，请耐心等待小说下载完成再查看！另外如果你要下载之前已经下载过的小说(在此之前已经删除了原txt文件)，那么你有可能会遇到"所有章节已是最新，无需下载"的情况，这时就请删除掉chapter.json，然后再次运行程序。
+  开始下载之后，您可能会过于着急而查看下载文件的位置，这是徒劳的，请耐心等待小说下载完成再查看！另外如果你要下载之前已经下载过的小说(在此之前已经删除了原txt文件)，程序会自动重新生成，本地缓存中的章节不会重新下载。
 
   另：如果您有番茄api，按照您的意愿投到"Issues"页中。
 ------------------------------------------""")
         
         use_official = input("是否启用官方API (y/n)：").strip().lower()
         if use_official == 'y':
-            print("正在启用官方API...")
-            if start_official_api():
-                CONFIG["official_api"]["enabled"] = True
-                print("官方API已启用")
-            else:
-                fallback = "http://0.0.0.0:8080/content"
-                CONFIG["official_api"]["batch_endpoint"] = fallback
-                print_once(f"启用官方API失败，已切换 {fallback}，正在重试...")
-                if start_official_api():
-                    CONFIG["official_api"]["enabled"] = True
-                    print("官方API已启用")
-                else:
-                    print("官方API启用失败，请检查 api.py 或环境后重试")
-                    return
+            if not enable_official_api():
+                return
         else:
             print("当前程序仅支持官方API，目前暂时放弃对第三方API的使用。程序退出。")
             return
@@ -660,6 +3180,7 @@ def main():
             file_format = input("请选择下载操作 (1:txt, 2:epub, 3:指定章节范围)：").strip()
             start_chapter = None
             end_chapter = None
+            chapters = None
             
             if file_format == '1':
                 file_format = 'txt'
@@ -689,7 +3210,7 @@ def main():
                 file_format = 'txt'
             
             try:
-                Run(book_id, save_path, file_format, start_chapter, end_chapter)
+                Run(book_id, save_path, file_format, start_chapter, end_chapter, chapters)
             except Exception as e:
                 print(f"运行错误: {str(e)}")
             
@@ -699,4 +3220,9 @@ def main():
         stop_web_service()
         
 if __name__ == "__main__":
+    # 打包为可执行文件时进程池需要
+    import multiprocessing
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()
\ No newline at end of file
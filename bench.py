@@ -0,0 +1,381 @@
+"""番茄小说下载器性能基准
+
+用法:
+    python bench.py clean      章节内容清洗：校验与旧实现输出一致并对比耗时
+    python bench.py run        端到端下载：启动本地模拟服务，完整运行 Run 并统计吞吐量
+    python bench.py serve      单独启动模拟服务（模拟 api.py 的 /content 接口和番茄小说的目录、书籍页面）
+    python bench.py import     冷启动：在新进程中导入 2.py 的耗时，以及导入后已加载的重量级模块
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_downloader():
+    """导入 2.py（文件名以数字开头，只能用 importlib 导入）"""
+    return importlib.import_module("2")
+
+
+def reference_process_chapter_content(content):
+    """旧版 process_chapter_content 加上 Run 中的缩进处理，作为对照基准"""
+    if not content or not isinstance(content, str):
+        return ""
+
+    paragraphs = []
+    if '<p idx=' in content:
+        paragraphs = re.findall(r'<p idx="\d+">(.*?)</p>', content, re.DOTALL)
+    else:
+        paragraphs = content.split('\n')
+
+    if paragraphs:
+        first_para = paragraphs[0].strip()
+        if not first_para.startswith('　　'):
+            paragraphs[0] = '　　' + first_para
+
+    cleaned_content = "\n".join(p.strip() for p in paragraphs if p.strip())
+    formatted_content = '\n'.join('　　' + line if line.strip() else line
+                                  for line in cleaned_content.split('\n'))
+
+    formatted_content = re.sub(r'<header>.*?</header>', '', formatted_content, flags=re.DOTALL)
+    formatted_content = re.sub(r'<footer>.*?</footer>', '', formatted_content, flags=re.DOTALL)
+    formatted_content = re.sub(r'</?article>', '', formatted_content)
+    formatted_content = re.sub(r'<[^>]+>', '', formatted_content)
+    formatted_content = re.sub(r'\\u003c|\\u003e', '', formatted_content)
+
+    formatted_content = re.sub(r'\n{3,}', '\n\n', formatted_content).strip()
+    return re.sub(r'^(\s*)', r'　　', formatted_content, flags=re.MULTILINE)
+
+
+# 清洗校验语料：覆盖官方接口的常见格式和各种边界情况
+GOLDEN_CORPUS = [
+    '<header><div class="tt-title">第一章</div></header><article><p idx="1">第一段</p><p idx="2">第二段</p></article><footer>完</footer>',
+    '<p idx="1">　　已缩进的段落</p><p idx="2">  半角空格  </p><p idx="3"></p><p idx="4">最后</p>',
+    '<p idx="1">段落里有\n换行</p><p idx="2">\n\n\n多个空行\n\n\n</p>',
+    '<p idx="1">带<span>标签</span>的段落</p><p idx="2">\\u003c转义\\u003e</p>',
+    '<p idx="1">跨段落<header>页眉</p><p idx="2">还是页眉</header>正文</p>',
+    '纯文本第一行\n\n  第二行  \n　　第三行\n\n\n\n第四行',
+    '纯文本<article>里有</article>标签\n<footer>脚注</footer>',
+    '<p idx="1">   </p><p idx="2">\t</p>',
+    '<p idx="x">格式不对</p>',
+    '\n\n\n',
+    '单行',
+    '',
+]
+
+
+def random_chapter(rng):
+    """生成随机章节内容，用于模糊比对"""
+    pieces = ['正文', '段落', 'abc', ' ', '　', '\n', '\t', '<', '>', '<b>', '</b>',
+              '<header>', '</header>', '<footer>', '</footer>', '<article>', '</article>',
+              '\\u003c', '\\u003e', '<p idx="1">', '<p idx="22">', '</p>']
+    return ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 40)))
+
+
+def sample_chapter(paragraphs=80):
+    """生成接近真实章节的内容"""
+    body = ''.join(f'<p idx="{i}">' + f'这是第{i}段正文内容，用来测试章节清洗的速度。' * 3 + '</p>'
+                   for i in range(paragraphs))
+    return f'<header><div class="tt-title">第一章</div></header><article>{body}</article><footer></footer>'
+
+
+def bench_clean(args):
+    downloader = load_downloader()
+    process = downloader.process_chapter_content
+
+    rng = random.Random(args.seed)
+    cases = GOLDEN_CORPUS + [random_chapter(rng) for _ in range(args.fuzz)]
+    for content in cases:
+        expected = reference_process_chapter_content(content)
+        actual = process(content)
+        if actual != expected:
+            print(f"输出不一致:\n输入: {content!r}\n期望: {expected!r}\n实际: {actual!r}")
+            return 1
+    print(f"输出校验通过：{len(GOLDEN_CORPUS)} 条固定语料，{args.fuzz} 条随机语料")
+
+    content = sample_chapter()
+    for label, func in (("旧实现", reference_process_chapter_content), ("新实现", process)):
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            func(content)
+        elapsed = time.perf_counter() - started
+        print(f"{label}: {elapsed / args.rounds * 1e6:.1f} 微秒/章")
+    return 0
+
+
+# 只在实际下载时才需要的模块，导入 2.py 时不应加载
+HEAVY_MODULES = ["requests", "urllib3", "bs4", "tqdm", "asyncio", "aiohttp", "subprocess",
+                 "fake_useragent", "http.server", "concurrent.futures.process"]
+
+IMPORT_PROBE = """
+import importlib, json, sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+importlib.import_module("2")
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "modules": [name for name in json.loads(sys.argv[2]) if name in sys.modules]}))
+"""
+
+
+def bench_import(args):
+    root = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    loaded = []
+    for _ in range(args.rounds):
+        output = subprocess.run([sys.executable, "-c", IMPORT_PROBE, root, json.dumps(HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        loaded = result["modules"]
+    timings.sort()
+    print(f"导入 2.py: 中位数 {timings[len(timings) // 2] * 1000:.1f} 毫秒，最快 {timings[0] * 1000:.1f} 毫秒（{args.rounds} 次）")
+    print(f"已加载的重量级模块: {', '.join(loaded) if loaded else '无'}")
+    return 1 if loaded and args.strict else 0
+
+
+def make_mock_handler(args):
+    """模拟服务：/content 按参数模拟延迟、错误和缺章，目录与书籍页面返回固定的测试书"""
+    stats = {"requests": 0, "bytes": 0}
+    stats_lock = threading.Lock()
+    paragraph = "这是模拟章节的正文内容。"
+    paragraph_count = max(1, args.body_size // len(paragraph.encode("utf-8")) // 8)
+    body = "".join(f'<p idx="{i}">' + paragraph * 8 + '</p>' for i in range(paragraph_count))
+
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def send(self, status, payload, content_type="application/json; charset=utf-8", trickle=0, etag=False):
+            data = payload.encode("utf-8")
+            tag = f'"{zlib.crc32(data):08x}"' if etag else None
+            if tag and self.headers.get("If-None-Match") == tag:
+                # 内容未变，条件请求只返回304
+                status, data = 304, b""
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            if tag:
+                self.send_header("ETag", tag)
+            self.end_headers()
+            if trickle:
+                # 分段发送，模拟响应体在trickle秒内逐步到达
+                pieces = range(0, len(data), 16 * 1024)
+                for start in pieces:
+                    self.wfile.write(data[start:start + 16 * 1024])
+                    self.wfile.flush()
+                    time.sleep(trickle / len(pieces))
+            else:
+                self.wfile.write(data)
+            with stats_lock:
+                stats["requests"] += 1
+                stats["bytes"] += len(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/content":
+                slow = args.slow_factor if random.random() < args.slow_rate else 1
+                latency = args.latency / 1000 * random.uniform(0.5, 1.5) * slow
+                trickle = latency / 2 if args.trickle else 0
+                time.sleep(latency - trickle)
+                if random.random() < args.error_rate:
+                    self.send(500, "{}")
+                    return
+                ids = [i for i in query.get("item_ids", [""])[0].split(",") if i]
+                chapters = {i: {"title": f"第{i}章", "content": body}
+                            for i in ids if random.random() >= args.missing_rate}
+                self.send(200, json.dumps(chapters, ensure_ascii=False), trickle=trickle)
+            elif url.path == "/api/reader/directory/detail":
+                ids = [str(1000000 + i) for i in range(args.chapters)]
+                volume = [{"itemId": item_id, "title": f"第{i + 1}章"} for i, item_id in enumerate(ids)]
+                self.send(200, json.dumps({"data": {"allItemIds": ids, "chapterListWithVolume": [volume]}},
+                                          ensure_ascii=False), etag=True)
+            elif url.path.startswith("/page/"):
+                self.send(200, '<h1>基准测试书</h1><div class="author-name"><span class="author-name-text">'
+                               '测试作者</span></div><div class="page-abstract-content"><p>简介</p></div>',
+                          "text/html; charset=utf-8", etag=True)
+            elif url.path == "/stats":
+                # send会再次获取stats_lock，先取出快照再发送
+                with stats_lock:
+                    payload = json.dumps(stats)
+                self.send(200, payload)
+            else:
+                self.send(404, "{}")
+
+    return MockHandler
+
+
+def bench_serve(args):
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_mock_handler(args))
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb():
+    """本进程的峰值内存（不含模拟服务），Windows 上不可用"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def bench_run(args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port),
+         "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+         "--missing-rate", str(args.missing_rate), "--body-size", str(args.body_size),
+         "--slow-rate", str(args.slow_rate), "--slow-factor", str(args.slow_factor),
+         *(["--trickle"] if args.trickle else []),
+         "--chapters", str(args.chapters)])
+    try:
+        downloader = load_downloader()
+        base = f"http://127.0.0.1:{port}"
+        if not downloader.wait_for_api("127.0.0.1", port, time.time() + 10, server):
+            print("模拟服务启动失败")
+            return 1
+
+        config = downloader.CONFIG
+        config["site_base"] = base
+        config["engine"] = args.engine
+        config["cache"]["enabled"] = False
+        config["metadata_cache"]["enabled"] = False
+        config["pipeline"]["processes"] = args.processes
+        config["hedge"]["enabled"] = args.hedge
+        config["official_api"]["stream"] = not args.no_stream
+        config["rate_limit"]["requests_per_second"] = args.requests_per_second
+        config["rate_limit"]["chapters_per_second"] = args.chapters_per_second
+        config["rate_limit"]["shared"] = False
+        config["official_api"]["enabled"] = True
+        config["official_api"]["batch_endpoint"] = f"{base}/content"
+        downloader.set_api_backends([f"{base}/content"])
+
+        # 记录每批请求的耗时和第一章写入输出文件的时间
+        latencies = []
+        controller = downloader.get_controller()
+        record = controller.record
+
+        def timed_record(latency, *rest):
+            latencies.append(latency)
+            record(latency, *rest)
+        controller.record = timed_record
+
+        first_written = []
+        for writer_class in (downloader.TxtChapterWriter, downloader.EpubChapterWriter):
+            def timed_add(self, *rest, _add=writer_class.add):
+                if not first_written:
+                    first_written.append(time.perf_counter())
+                return _add(self, *rest)
+            writer_class.add = timed_add
+
+        with tempfile.TemporaryDirectory() as save_path:
+            started = time.perf_counter()
+            output = downloader.Run("1", save_path, args.format, resume=False)
+            elapsed = time.perf_counter() - started
+            journal = downloader.load_status(save_path, "1", args.format)
+            completed = len(journal.done)
+            journal.close()
+
+        stats = json.loads(downloader.make_request(f"{base}/stats").text)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if not output:
+        print("下载失败")
+        return 1
+    rss = peak_rss_mb()
+    print(f"\n引擎 {args.engine}，格式 {args.format}，完成 {completed}/{args.chapters} 章，耗时 {elapsed:.2f} 秒")
+    print(f"吞吐量: {completed / elapsed:.1f} 章/秒，{stats['bytes'] / elapsed / 1024:.1f} KB/秒（共 {stats['requests']} 次请求）")
+    print(f"批量请求耗时: p50 {percentile(latencies, 0.5) * 1000:.0f} 毫秒，p95 {percentile(latencies, 0.95) * 1000:.0f} 毫秒")
+    if first_written:
+        print(f"首章写入耗时: {first_written[0] - started:.2f} 秒")
+    print(f"峰值内存: {rss:.1f} MB" if rss is not None else "峰值内存: 不可用")
+    events = downloader.metrics.summary()["events"]
+    if args.hedge:
+        print(f"对冲请求: 发出 {events.get('hedge_sent', 0)} 次，胜出 {events.get('hedge_won', 0)} 次")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="番茄小说下载器性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    clean_parser = subparsers.add_parser("clean", help="章节内容清洗基准")
+    clean_parser.add_argument("--rounds", type=int, default=2000)
+    clean_parser.add_argument("--fuzz", type=int, default=20000)
+    clean_parser.add_argument("--seed", type=int, default=0)
+    clean_parser.set_defaults(func=bench_clean)
+
+    def add_mock_arguments(sub_parser):
+        sub_parser.add_argument("--chapters", type=int, default=1000, help="测试书的章节数")
+        sub_parser.add_argument("--latency", type=float, default=200, help="每批请求的平均延迟（毫秒）")
+        sub_parser.add_argument("--slow-rate", type=float, default=0, help="请求变慢（长尾）的概率")
+        sub_parser.add_argument("--slow-factor", type=float, default=10, help="变慢的请求延迟放大的倍数")
+        sub_parser.add_argument("--trickle", action="store_true", help="一半延迟花在分段发送响应体上，模拟响应逐步到达")
+        sub_parser.add_argument("--error-rate", type=float, default=0.02, help="整批请求返回500的概率")
+        sub_parser.add_argument("--missing-rate", type=float, default=0.05, help="单个章节缺失的概率")
+        sub_parser.add_argument("--body-size", type=int, default=6000, help="每章正文的字节数")
+
+    import_parser = subparsers.add_parser("import", help="冷启动导入耗时")
+    import_parser.add_argument("--rounds", type=int, default=10)
+    import_parser.add_argument("--strict", action="store_true", help="导入时加载了重量级模块则返回非零")
+    import_parser.set_defaults(func=bench_import)
+
+    run_parser = subparsers.add_parser("run", help="端到端下载基准")
+    add_mock_arguments(run_parser)
+    run_parser.add_argument("--engine", choices=["thread", "async"], default="thread")
+    run_parser.add_argument("--format", choices=["txt", "epub"], default="txt")
+    run_parser.add_argument("--processes", type=int, default=0, help="章节清洗的进程数")
+    run_parser.add_argument("--hedge", action="store_true", help="启用对冲请求")
+    run_parser.add_argument("--requests-per-second", type=float, default=0, help="限速：每秒请求数")
+    run_parser.add_argument("--chapters-per-second", type=float, default=0, help="限速：每秒章节数")
+    run_parser.add_argument("--no-stream", action="store_true", help="整个批量响应下载完再解析")
+    run_parser.set_defaults(func=bench_run)
+
+    serve_parser = subparsers.add_parser("serve", help="启动模拟服务")
+    add_mock_arguments(serve_parser)
+    serve_parser.add_argument("--port", type=int, default=18080)
+    serve_parser.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())